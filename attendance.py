@@ -0,0 +1,108 @@
+# Marks a user whose resolution is not cached (None is a cached "not in the roster")
+_UNRESOLVED = object()
+
+
+class AttendanceError(Exception):
+    """Raised when the attendees cannot be determined. The message is shown to the user as is."""
+
+
+class AttendanceIndex:
+    """
+    Maps Discord users to roster members for attendance-based grouping. A user is mapped by an explicit
+    link (link_member) or, failing that, by a display name (server nickname, global name or user name)
+    that matches exactly one roster name after normalization (see NameIndex.same_as).
+    Resolutions are cached per user; the bot's member events (forget) and roster changes invalidate them,
+    so resolving a voice channel or sign-up list never needs a Discord API call.
+    """
+
+    def __init__(self, guild_id, storage, roster, name_index):
+        self.guild_id = guild_id
+        self.storage = storage
+        self.roster = roster
+        self.name_index = name_index
+        self.links = storage.load_member_links(guild_id)  # user_id -> member id
+        self._resolved = {}  # user_id -> member id or None
+
+    def __len__(self):
+        return len(self._resolved)
+
+    def resolve(self, user_id, display_names):
+        """
+        Returns the Member of a Discord user, or None if the user is not in the roster.
+        `display_names` are the user's names in order of preference; they are only used on a cache miss.
+        """
+        member_id = self._resolved.get(user_id, _UNRESOLVED)
+        if member_id is _UNRESOLVED:
+            member_id = self._lookup(user_id, display_names)
+            self._resolved[user_id] = member_id
+        return self.roster.by_id(member_id) if member_id is not None else None
+
+    def _lookup(self, user_id, display_names):
+        member_id = self.links.get(user_id)
+        if member_id is not None and self.roster.by_id(member_id) is not None:
+            return member_id
+        for name in display_names:
+            if not name:
+                continue
+            matches = self.name_index.same_as(name)
+            if len(matches) == 1:
+                return self.roster.get(matches[0]).id
+        return None
+
+    def link(self, user_id, member_id):
+        """Links a Discord user to a roster member (None removes the link)."""
+        if member_id is None:
+            self.links.pop(user_id, None)
+        else:
+            self.links[user_id] = member_id
+        self.storage.save_member_link(self.guild_id, user_id, member_id)
+        self._resolved.pop(user_id, None)
+
+    def forget(self, user_id):
+        """Drops the cached resolution of a user (call when the user's names change or the user leaves)."""
+        self._resolved.pop(user_id, None)
+
+    def roster_listener(self, event, member, old_name=None):
+        """Roster change callback: name matches may change with any add, remove or rename."""
+        if event == 'remove':
+            for user_id in [user_id for user_id, member_id in self.links.items() if member_id == member.id]:
+                self.link(user_id, None)
+        if event in ('add', 'remove', 'rename'):
+            self._resolved.clear()
+
+
+class SignupTracker:
+    """
+    Users who reacted to sign-up messages, kept up to date from reaction events.
+    A message is only tracked once it has been registered; a message posted before a restart is
+    registered with the reactions read from Discord once, and events keep it current from then on.
+    """
+
+    def __init__(self, max_messages=1000):
+        self.max_messages = max_messages
+        self._signups = {}  # message_id -> set of user ids, in registration order
+
+    def __contains__(self, message_id):
+        return message_id in self._signups
+
+    def register(self, message_id, user_ids=()):
+        self._signups.pop(message_id, None)
+        self._signups[message_id] = set(user_ids)
+        # Old sign-ups are dropped first
+        while len(self._signups) > self.max_messages:
+            del self._signups[next(iter(self._signups))]
+
+    def add(self, message_id, user_id):
+        users = self._signups.get(message_id)
+        if users is not None:
+            users.add(user_id)
+
+    def remove(self, message_id, user_id):
+        users = self._signups.get(message_id)
+        if users is not None:
+            users.discard(user_id)
+
+    def users(self, message_id):
+        """Returns the set of users signed up to a message, or None if the message is not tracked."""
+        users = self._signups.get(message_id)
+        return set(users) if users is not None else None
@@ -0,0 +1,189 @@
+"""
+Benchmark for team formation (form_groups) quality and speed, runnable without Discord.
+
+    python bench_grouping.py --output results.json
+    python bench_grouping.py --output new.json --compare results.json
+
+Synthetic rosters of each size are generated from a fixed seed, and every strategy is run with
+fixed seeds, so two runs on the same code give the same quality numbers. --compare reports the
+cases where the new results are slower or worse in quality than the baseline file.
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from grouping import PROFESSIONS, GroupingError, form_groups
+from roster import Member
+
+# Profession mix and power distribution of the seed roster
+PROFESSION_WEIGHTS = {'剣士': 8, '騎士': 5, '魔導士': 15, '賢者': 8}
+POWER_MEAN = 1650
+POWER_STDEV = 200
+# Fraction of members who are leader candidates
+LEADER_FRACTION = 0.25
+CAPS = {'max_sages': 1, 'max_knights': 1, 'max_swordsmen': 1}
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+DEFAULT_STRATEGIES = ('balance', 'high_power', 'carry')
+# Relative slowdown and absolute quality change tolerated by --compare
+TIME_TOLERANCE = 0.2
+QUALITY_TOLERANCE = 0.01
+
+
+def generate_roster(size, seed):
+    """Returns (members, leader_candidates) for a synthetic roster of `size` members."""
+    rng = random.Random(seed)
+    professions = rng.choices(list(PROFESSION_WEIGHTS), weights=list(PROFESSION_WEIGHTS.values()), k=size)
+    members = [
+        Member(index, f'member{index:05d}', profession, max(100, int(rng.gauss(POWER_MEAN, POWER_STDEV))))
+        for index, profession in enumerate(professions)
+    ]
+    leaders = [member.name for member in rng.sample(members, max(1, int(size * LEADER_FRACTION)))]
+    return members, leaders
+
+
+def team_quality(result, members):
+    """Per-team rates of a form_groups result: cap violations, missing front liner/healer and no leader."""
+    caps = {'賢者': CAPS['max_sages'], '騎士': CAPS['max_knights'], '剣士': CAPS['max_swordsmen']}
+    teams = [
+        [members[member_id] for member_id in team['members'] + ([team['leader']] if team['leader'] is not None else [])]
+        for team in result['teams']
+    ]
+    violating = missing_role = 0
+    for team in teams:
+        counts = {}
+        for member in team:
+            counts[member.profession] = counts.get(member.profession, 0) + 1
+        if any(counts.get(profession, 0) > cap for profession, cap in caps.items()):
+            violating += 1
+        has_front = any(PROFESSIONS[member.profession] == '前衛' for member in team)
+        if not has_front or not counts.get('賢者'):
+            missing_role += 1
+    num_teams = max(len(teams), 1)
+    return {
+        'teams': len(teams),
+        'power_stdev': result['score']['power_stdev'],
+        'violation_rate': violating / num_teams,
+        'missing_role_rate': missing_role / num_teams,
+        'leaderless_rate': sum(1 for team in result['teams'] if team['leader'] is None) / num_teams,
+        'score': result['score']['total']
+    }
+
+
+def run_case(members, leaders, strategy, seed, time_budget, measure_memory):
+    carried = [min(members, key=lambda member: member.power).name] if strategy == 'carry' else []
+    params = dict(
+        roster_members=members, leader_candidates=leaders, excluded_list=[], carried_list=carried,
+        fixed_list=[], fixed_probability=1.0, preferred_list=[], preferred_probability=1.0,
+        group_type=strategy, time_budget=time_budget, seed=seed, **CAPS
+    )
+    start = time.perf_counter()
+    result = form_groups(**params)
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if measure_memory:
+        # Separate run: tracing allocations slows the code down too much to time it at the same time
+        tracemalloc.start()
+        form_groups(**params)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak, team_quality(result, members)
+
+
+def run_benchmark(sizes, strategies, seeds, time_budget, measure_memory=True, log=print):
+    cases = []
+    for size in sizes:
+        members, leaders = generate_roster(size, seed=size)
+        for strategy in strategies:
+            runs = []
+            for seed in range(seeds):
+                try:
+                    runs.append(run_case(members, leaders, strategy, seed, time_budget, measure_memory))
+                except GroupingError:
+                    break
+            if not runs:
+                log(f'{size:>6} {strategy:<10} skipped (roster too small)')
+                continue
+            case = {
+                'size': size,
+                'strategy': strategy,
+                'runs': len(runs),
+                'wall_time_median': statistics.median(run[0] for run in runs),
+                'wall_time_max': max(run[0] for run in runs),
+                'peak_alloc_bytes': max(run[1] for run in runs) if measure_memory else None
+            }
+            for key in runs[0][2]:
+                case[key] = statistics.mean(run[2][key] for run in runs)
+            cases.append(case)
+            log(
+                f'{size:>6} {strategy:<10} {case["wall_time_median"] * 1000:8.1f}ms '
+                f'stdev {case["power_stdev"]:7.1f}  violations {case["violation_rate"]:.3f}  '
+                f'missing roles {case["missing_role_rate"]:.3f}  leaderless {case["leaderless_rate"]:.3f}'
+                + (f'  peak {case["peak_alloc_bytes"] / 1024:.0f}KiB' if measure_memory else '')
+            )
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'time_budget': time_budget,
+        'seeds': seeds,
+        'cases': cases
+    }
+
+
+def compare(baseline, current):
+    """Returns a list of regressions (slower, or worse in any quality metric) of `current` against `baseline`."""
+    regressions = []
+    previous = {(case['size'], case['strategy']): case for case in baseline['cases']}
+    for case in current['cases']:
+        old = previous.get((case['size'], case['strategy']))
+        if old is None:
+            continue
+        name = f'{case["size"]} {case["strategy"]}'
+        if case['wall_time_median'] > old['wall_time_median'] * (1 + TIME_TOLERANCE):
+            regressions.append(f'{name}: wall time {old["wall_time_median"] * 1000:.1f}ms -> {case["wall_time_median"] * 1000:.1f}ms')
+        if case['power_stdev'] > old['power_stdev'] * (1 + QUALITY_TOLERANCE):
+            regressions.append(f'{name}: power stdev {old["power_stdev"]:.1f} -> {case["power_stdev"]:.1f}')
+        for key in ('violation_rate', 'missing_role_rate', 'leaderless_rate'):
+            if case[key] > old[key] + QUALITY_TOLERANCE:
+                regressions.append(f'{name}: {key} {old[key]:.3f} -> {case[key]:.3f}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help='comma separated roster sizes')
+    parser.add_argument('--strategies', default=','.join(DEFAULT_STRATEGIES), help='comma separated group types')
+    parser.add_argument('--seeds', type=int, default=3, help='runs (seeds 0..n-1) per size and strategy')
+    parser.add_argument('--time-budget', type=float, default=0.3, help='optimizer budget passed to form_groups')
+    parser.add_argument('--no-memory', action='store_true', help='skip the allocation measurement runs')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file; exits with status 1 on regressions')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(
+        [int(size) for size in args.sizes.split(',')], args.strategies.split(','),
+        args.seeds, args.time_budget, measure_memory=not args.no_memory
+    )
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(json.load(f), results)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+        print('no regressions')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
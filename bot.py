@@ -5,167 +5,500 @@ from discord import app_commands
 from dotenv import load_dotenv
 import random
 import logging
+import asyncio
+import signal
+import functools
+import hashlib
+import json
+import math
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from discord.ext import tasks
 from flask import Flask
 from threading import Thread
 
+from storage import Storage
+from grouping import PROFESSIONS, GroupingError, form_groups, repair_groups
+from pagination import send_paginated, send_text
+from shards import ShardManager
+from selection import SelectionConflict
+from attendance import AttendanceError, SignupTracker
+from history import PERCENTILES, PowerState, format_time, parse_date, roster_percentiles, top_gainers as find_top_gainers
+from health import HealthPublisher
+from loop_watchdog import LoopWatchdog
+from metrics import REGISTRY, instrumented, mark_deferred, stage, start_logging
+from seed import SeedError, SeedFile
+from roster_io import RosterImportError, read_rows, validate_rows, diff_roster, write_roster
+
 # Load the token from a .env file
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 
+# Log records are written to stdout by a background thread, never from the event loop
+LOG_LISTENER = start_logging(os.getenv('LOG_LEVEL', 'INFO').upper())
+logger = logging.getLogger('tansan')
+
+# Metrics are dumped to this file every METRICS_DUMP_INTERVAL seconds; web.py serves it at /metrics
+METRICS_PATH = os.getenv('METRICS_PATH', 'metrics.prom')
+METRICS_DUMP_INTERVAL = float(os.getenv('METRICS_DUMP_INTERVAL', '15'))
+
+# Health snapshot published to shared memory every HEALTH_INTERVAL seconds for /healthz and /readyz in web.py.
+# Give each worker process its own HEALTH_SHM_NAME when running several (see SHARD_IDS).
+HEALTH = HealthPublisher(os.getenv('HEALTH_SHM_NAME', 'tansan_health'))
+HEALTH_INTERVAL = float(os.getenv('HEALTH_INTERVAL', '5'))
+
+# Event loop watchdog: stalls longer than WATCHDOG_THRESHOLD seconds are reported (with the blocking stack
+# and the running command) to WATCHDOG_REPORT_PATH as JSON Lines; WATCHDOG_SAMPLE_RATE is the fraction reported
+WATCHDOG = LoopWatchdog(
+    threshold=float(os.getenv('WATCHDOG_THRESHOLD', '0.25')),
+    sample_rate=float(os.getenv('WATCHDOG_SAMPLE_RATE', '1.0')),
+    report_path=os.getenv('WATCHDOG_REPORT_PATH', 'loop_stalls.jsonl')
+)
+
 # Configure bot permissions
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
+# Discord gateway sharding. By default one process runs every shard (AutoShardedBot decides the count).
+# To spread the gateway over several worker processes, give each one the same SHARD_COUNT and its own
+# SHARD_IDS (comma separated), e.g. SHARD_COUNT=4 with SHARD_IDS=0,1 and SHARD_IDS=2,3.
+# All processes must share the same DATABASE_PATH.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(',')] if os.getenv('SHARD_IDS') else None
+
+# Guild to sync the slash commands to directly (instant, for development); the global sync can take up to an hour
+DEV_GUILD_ID = int(os.getenv('DEV_GUILD_ID')) if os.getenv('DEV_GUILD_ID') else None
+# Set FORCE_COMMAND_SYNC=1 to sync even if the command tree has not changed
+FORCE_COMMAND_SYNC = os.getenv('FORCE_COMMAND_SYNC') == '1'
+commands_synced = False
+
 # Botインスタンスを作成
-bot = commands.Bot(command_prefix='!', intents=intents)
-
-# Dictionary to manage members to be excluded from auto group selection
-excluded_members = {}
-# Dictionary to manage members who are to be "carried"
-carried_members = {}
-# New: Dictionary to manage members who are "fixed" in a team
-fixed_teams = {}
-# New: Dictionary to manage members who are "preferred" for a fixed team
-preferred_members = {}
-
-# Define professions and their roles
-PROFESSIONS = {
-    '剣士': '前衛',
-    '騎士': '前衛',
-    '魔導士': '後衛',
-    '賢者': '後衛'
+bot = commands.AutoShardedBot(command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+
+# Seed roster (members and leader candidates) for guilds that use the bot for the first time.
+# The file is checked for changes every SEED_RELOAD_INTERVAL seconds and reloaded without a restart.
+SEED = SeedFile(os.getenv('SEED_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seed_roster.json')))
+SEED_RELOAD_INTERVAL = float(os.getenv('SEED_RELOAD_INTERVAL', '30'))
+
+# Persistent storage. Commands only queue their changes; flush_storage writes them in batches.
+STORAGE = Storage(os.getenv('DATABASE_PATH', 'tansan.db'))
+STORAGE_FLUSH_INTERVAL = float(os.getenv('STORAGE_FLUSH_INTERVAL', '2.0'))
+# How often (seconds) to check whether another bot process has changed a loaded guild's state
+STORAGE_SYNC_INTERVAL = float(os.getenv('STORAGE_SYNC_INTERVAL', '2.0'))
+
+# Time budget (seconds) for the team optimizer in create_groups
+GROUPING_TIME_BUDGET = float(os.getenv('GROUPING_TIME_BUDGET', '0.3'))
+# Upper limit of candidate groupings generated for one auto_create_group call
+MAX_GROUPING_CANDIDATES = 64
+
+# Team formation runs in worker processes so that the event loop never blocks.
+# If a request is not finished within GROUPING_TIMEOUT seconds, it falls back to the fast heuristic.
+GROUPING_WORKERS = int(os.getenv('GROUPING_WORKERS', str(min(4, os.cpu_count() or 1))))
+GROUPING_TIMEOUT = float(os.getenv('GROUPING_TIMEOUT', '5.0'))
+grouping_pool = None
+
+# Sign-up messages posted by start_signup: users who react with SIGNUP_EMOJI attend, tracked from reaction events
+SIGNUP_EMOJI = '✋'
+SIGNUPS = SignupTracker()
+
+# Number of members shown per page by member_list and power_list
+MEMBERS_PER_PAGE = 20
+# Number of power changes shown by power_history, and the largest count / period accepted by top_gainers
+POWER_HISTORY_ENTRIES = 20
+MAX_TOP_GAINERS = 50
+MAX_GAIN_DAYS = 365
+# Longest name shown in lists (keeps every page within Discord's message limit)
+MAX_DISPLAY_NAME = 32
+# Largest roster file accepted by import_roster (bytes), and the number of problems/changes listed in its reply
+MAX_IMPORT_BYTES = 1024 * 1024
+MAX_IMPORT_DETAILS = 20
+
+# Per-guild shards (roster, leader candidates, selection state and caches), loaded on first use
+# and evicted from memory after SHARD_IDLE_TIMEOUT seconds without commands.
+# A user's selection state is dropped from memory after SELECTION_TTL seconds without use (it stays saved).
+SHARDS = ShardManager(
+    STORAGE,
+    idle_timeout=float(os.getenv('SHARD_IDLE_TIMEOUT', '1800')),
+    cache_size=int(os.getenv('GROUPING_CACHE_SIZE', '128')),
+    selection_ttl=float(os.getenv('SELECTION_TTL', '600')),
+    seed_members=SEED.members,
+    seed_leader_candidates=SEED.leader_candidates
+)
+
+GROUP_TYPE_HEADERS = {
+    'balance': '**🤖 自動グループ編成結果 (バランス型)**\n\n',
+    'high_power': '**🤖 自動グループ編成結果 (高戦力型)**\n\n',
+    'carry': '**🤖 自動グループ編成結果 (キャリー型)**\n\n'
 }
 
-# Overall ranking list (name, profession, power)
-OVERALL_RANKS = [
-    {'name': 'ちるっと', 'profession': '剣士', 'power': 2000},
-    {'name': 'ほんあり', 'profession': '騎士', 'power': 1980},
-    {'name': 'ひらぱー', 'profession': '魔導士', 'power': 1960},
-    {'name': '炭酸', 'profession': '魔導士', 'power': 1940},
-    {'name': 'きゅーりー', 'profession': '騎士', 'power': 1920},
-    {'name': 'chami', 'profession': '魔導士', 'power': 1900},
-    {'name': 'ノク', 'profession': '魔導士', 'power': 1880},
-    {'name': '金パチ', 'profession': '賢者', 'power': 1860},
-    {'name': 'Jackal', 'profession': '魔導士', 'power': 1840},
-    {'name': 'シュシュリカ', 'profession': '賢者', 'power': 1820},
-    {'name': '乳酸菌', 'profession': '魔導士', 'power': 1800},
-    {'name': 'もや', 'profession': '騎士', 'power': 1780},
-    {'name': 'かなり', 'profession': '剣士', 'power': 1760},
-    {'name': 'つきみや', 'profession': '魔導士', 'power': 1740},
-    {'name': 'おなまえ', 'profession': '賢者', 'power': 1720},
-    {'name': 'ことりり', 'profession': '魔導士', 'power': 1700},
-    {'name': 'Coco', 'profession': '魔導士', 'power': 1680},
-    {'name': 'しの', 'profession': '賢者', 'power': 1660},
-    {'name': 'せど', 'profession': '剣士', 'power': 1640},
-    {'name': '月宮', 'profession': '賢者', 'power': 1630},
-    {'name': 'kazu', 'profession': '魔導士', 'power': 1620},
-    {'name': 'もん', 'profession': '剣士', 'power': 1600},
-    {'name': 'あい', 'profession': '剣士', 'power': 1580},
-    {'name': 'INTP', 'profession': '賢者', 'power': 1560},
-    {'name': 'Tera', 'profession': '魔導士', 'power': 1540},
-    {'name': 'JIN', 'profession': '賢者', 'power': 1520},
-    {'name': '96', 'profession': '魔導士', 'power': 1500},
-    {'name': 'しらす', 'profession': '賢者', 'power': 1480},
-    {'name': 'ジークアクス', 'profession': '騎士', 'power': 1460},
-    {'name': 'くにお', 'profession': '剣士', 'power': 1440},
-    {'name': 'みんふぁ', 'profession': '魔導士', 'power': 1420},
-    {'name': 'ぽんずー', 'profession': '魔導士', 'power': 1400},
-    {'name': 'ぽりんきー', 'profession': '剣士', 'power': 1360},
-    {'name': 'おとも', 'profession': '魔導士', 'power': 1340},
-    {'name': 'ぱんどら', 'profession': '騎士', 'power': 1320},
-    {'name': 'うさちゃ', 'profession': '魔導士', 'power': 1300}
-]
-
-# Generate profession-specific power rankings
-PLAYER_RANKS = {}
-
-def rebuild_player_ranks():
-    """Helper function to rebuild PLAYER_RANKS from OVERALL_RANKS"""
-    PLAYER_RANKS.clear()
-    for profession in PROFESSIONS:
-        PLAYER_RANKS[profession] = sorted([
-            (p['name'], p['power']) for p in OVERALL_RANKS if p['profession'] == profession
-        ], key=lambda x: x[1], reverse=True)
+async def get_shard(interaction: discord.Interaction):
+    """
+    Helper function to get the shard of the guild an interaction came from (0 for direct messages),
+    loading it in a worker thread if it is not in memory.
+    """
+    return await SHARDS.get_async(interaction.guild_id or 0)
+
+def get_grouping_pool():
+    """
+    Helper function to get the worker process pool for team formation, creating it on first use.
+    """
+    global grouping_pool
+    if grouping_pool is None:
+        # fork keeps the workers from re-importing bot.py (which would reopen the database)
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        grouping_pool = ProcessPoolExecutor(max_workers=GROUPING_WORKERS, mp_context=context)
+    return grouping_pool
+
+async def run_grouping(seed, candidates=1, **params):
+    """
+    Runs form_groups `candidates` times in parallel in the worker pool and returns the results
+    sorted by score (best first). The candidates' seeds are derived from `seed`, so the same seed
+    gives the same results (unless a candidate is marked 'time_limited', see form_groups).
+    Candidates that are not finished within GROUPING_TIMEOUT are cancelled; if only some finished,
+    the finished ones are marked with 'partial' (the same seed may give another best), and if none finished
+    (or the pool is broken), the fast heuristic (no optimizer pass) is run in a worker thread instead and the
+    result is marked with 'fallback'.
+    """
+    global grouping_pool
+    loop = asyncio.get_running_loop()
+    pool = get_grouping_pool()
+    seed_rng = random.Random(seed)
+    seeds = [seed] if candidates == 1 else [seed_rng.randrange(2 ** 32) for _ in range(candidates)]
+    futures = [
+        loop.run_in_executor(pool, functools.partial(form_groups, time_budget=GROUPING_TIME_BUDGET, seed=candidate_seed, **params))
+        for candidate_seed in seeds
+    ]
+    try:
+        done, pending = await asyncio.wait(futures, timeout=GROUPING_TIMEOUT)
+    finally:
+        for future in futures:
+            future.cancel()
+
+    results = []
+    for future in done:
+        error = future.exception()
+        if error is None:
+            results.append(future.result())
+        elif isinstance(error, BrokenProcessPool):
+            if grouping_pool is pool:
+                logger.warning('グループ編成のワーカープロセスが異常終了しました。プールを作り直します。')
+                pool.shutdown(wait=False, cancel_futures=True)
+                grouping_pool = None
+        else:
+            raise error
+
+    if not results:
+        logger.warning('グループ編成が%s秒以内に終わらなかったため、簡易編成に切り替えます。', GROUPING_TIMEOUT)
+        # In a thread, not the (possibly broken) pool; the heuristic alone still must not block the event loop
+        result = await asyncio.to_thread(functools.partial(form_groups, time_budget=0, seed=seed, **params))
+        result['fallback'] = True
+        results.append(result)
+    elif len(results) < len(futures):
+        logger.warning('グループ編成の候補%s件中%s件が%s秒以内に終わりませんでした。', len(futures), len(futures) - len(results), GROUPING_TIMEOUT)
+        for result in results:
+            result['partial'] = True
+
+    results.sort(key=lambda result: (result['score']['total'], result['seed']))
+    return results
+
+@tasks.loop(seconds=STORAGE_FLUSH_INTERVAL)
+async def flush_storage():
+    """Writes the queued changes to the database without blocking the event loop."""
+    await asyncio.to_thread(STORAGE.flush)
+
+@tasks.loop(seconds=STORAGE_SYNC_INTERVAL)
+async def sync_shards():
+    """Drops the shards whose state another bot process has changed; they are reloaded on their next use."""
+    stale = await asyncio.to_thread(STORAGE.stale_guilds)
+    if stale:
+        SHARDS.drop_stale(stale)
+
+@tasks.loop(seconds=SEED_RELOAD_INTERVAL)
+async def reload_seed():
+    """Picks up edits of the seed file; an invalid file is reported and the previous seed is kept."""
+    try:
+        reloaded = await asyncio.to_thread(SEED.reload_if_changed)
+    except SeedError as e:
+        logger.error('シードファイルの再読み込みに失敗しました: %s', e)
+        return
+    if reloaded:
+        SHARDS.set_seed(SEED.members, SEED.leader_candidates)
+        logger.info('シードファイルを再読み込みしました (%d人)。', len(SEED.members))
 
-rebuild_player_ranks()
+@tasks.loop(seconds=METRICS_DUMP_INTERVAL)
+async def dump_metrics():
+    """Writes the current metrics to METRICS_PATH for the /metrics endpoint of web.py."""
+    try:
+        await asyncio.to_thread(REGISTRY.dump, METRICS_PATH)
+    except OSError as e:
+        logger.warning('メトリクスの書き出しに失敗しました: %s', e)
 
-# Initialize list of leader candidates
-LEADER_CANDIDATES = [
-    'きゅーりー', 'もや', '炭酸', 'INTP', 'シュシュリカ', 'しの', 'つきみや', 'ぽんずー', '96'
-]
+def finite_or_none(value):
+    """
+    Helper function to turn the inf/nan latencies reported before the first heartbeat into None.
+    """
+    return value if value is not None and math.isfinite(value) else None
 
-def get_power_from_rank(profession, member_name):
+@tasks.loop(seconds=HEALTH_INTERVAL)
+async def publish_health():
+    """
+    Publishes heartbeat latency, shard status, event loop lag (the largest since the previous publish,
+    measured by the watchdog), roster size, cache hit rate and storage queue depth.
+    """
+    shards = [
+        {'id': shard_id, 'closed': shard.is_closed(), 'latency': finite_or_none(shard.latency)}
+        for shard_id, shard in sorted(bot.shards.items())
+    ]
+    hits = sum(shard.cache.hits for shard in SHARDS)
+    misses = sum(shard.cache.misses for shard in SHARDS)
+    HEALTH.publish({
+        'ready': bot.is_ready() and not bot.is_closed(),
+        'latency': finite_or_none(bot.latency),
+        'shards': shards,
+        'loop_lag': WATCHDOG.max_lag(),
+        'guilds_loaded': len(SHARDS),
+        'roster_size': sum(len(shard.roster) for shard in SHARDS),
+        'cache_hit_rate': hits / (hits + misses) if hits + misses else None,
+        'storage_queue': STORAGE.pending_count()
+    })
+
+@tasks.loop(seconds=60)
+async def evict_idle_shards():
+    """Drops the shards of guilds that have been idle for longer than SHARD_IDLE_TIMEOUT."""
+    SHARDS.evict_idle()
+
+async def add_to_selection(shard, user_id, category, names):
     """
-    Helper function to get power based on profession and member name.
+    Helper function to add members (by name) to one category of a user's selection.
+    Returns the names added, the names not in the roster and the (name, category label) conflicts.
     """
-    ranks = PLAYER_RANKS.get(profession)
-    if ranks:
-        for name, power in ranks:
-            if name == member_name:
-                return power
-    return None
+    selection = await shard.selections.get(user_id)
+    added, not_found, conflicts = [], [], []
+    for name in names:
+        member = shard.roster.get(name)
+        if member is None:
+            not_found.append(name)
+            continue
+        try:
+            if selection.add(category, member.id):
+                added.append(name)
+        except SelectionConflict as e:
+            conflicts.append((name, str(e)))
+    return added, not_found, conflicts
+
+def format_conflicts(conflicts):
+    """
+    Helper function to describe the members that could not be added because they are already in another list.
+    """
+    if not conflicts:
+        return ''
+    return '⚠️ ほかのリストに設定済みのため追加できなかったメンバー: ' + ', '.join(f'`{name}` ({label})' for name, label in conflicts) + '\n'
+
+async def collect_attendance(interaction, shard, attendance, voice_channel=None):
+    """
+    Helper function to get the roster members attending: the members of a voice channel (by default the
+    caller's) or the users who reacted to the guild's latest sign-up message. Discord users are mapped to
+    members with the shard's cached AttendanceIndex. Returns the members and the names of the attendees
+    that are not in the roster; raises AttendanceError if there are no attendees to read.
+    """
+    guild = interaction.guild
+    if guild is None:
+        raise AttendanceError('参加者による編成はサーバー内でのみ使用できます。')
+
+    if attendance == 'voice':
+        if voice_channel is None:
+            voice = getattr(interaction.user, 'voice', None)
+            if voice is None or voice.channel is None:
+                raise AttendanceError('ボイスチャンネルを指定するか、ボイスチャンネルに参加してから実行してください。')
+            voice_channel = voice.channel
+        users = [user for user in voice_channel.members if not user.bot]
+    else:
+        signup = await asyncio.to_thread(STORAGE.get_meta, f'signup:{guild.id}')
+        if signup is None:
+            raise AttendanceError('参加受付がありません。`/start_signup` で参加受付を開始してください。')
+        channel_id, message_id = map(int, signup.split(':'))
+        user_ids = SIGNUPS.users(message_id)
+        if user_ids is None:
+            # Not tracked since this process started: read the reactions once, events keep them current afterwards
+            user_ids = await fetch_signup_users(channel_id, message_id)
+        users = [user for user in map(guild.get_member, user_ids) if user is not None and not user.bot]
+
+    if not users:
+        raise AttendanceError('参加者がいません。')
+
+    members = []
+    unmatched = []
+    for user in users:
+        member = shard.attendance.resolve(user.id, (user.nick, user.global_name, user.name))
+        if member is None:
+            unmatched.append(user.display_name)
+        else:
+            members.append(member)
+    return members, unmatched
+
+async def fetch_signup_users(channel_id, message_id):
+    """
+    Helper function to read the users who reacted to a sign-up message and start tracking it.
+    """
+    try:
+        channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+        message = await channel.fetch_message(message_id)
+    except (discord.NotFound, discord.Forbidden):
+        raise AttendanceError('参加受付のメッセージが見つかりません。`/start_signup` で参加受付をやり直してください。')
+    user_ids = set()
+    for reaction in message.reactions:
+        if str(reaction.emoji) == SIGNUP_EMOJI:
+            user_ids.update([user.id async for user in reaction.users()])
+    SIGNUPS.register(message_id, user_ids)
+    return user_ids
+
+async def load_power_state(shard, ts):
+    """
+    Helper function to rebuild a guild's powers at time `ts` (None if the history does not go back that far),
+    after writing the queued changes so that they are included.
+    """
+    await asyncio.to_thread(STORAGE.flush)
+    return await asyncio.to_thread(PowerState.as_of, STORAGE, shard.guild_id, ts)
+
+def member_label(shard, member_id):
+    """
+    Helper function to show a member of the power history, who may have been removed from the roster since.
+    """
+    member = shard.roster.by_id(member_id)
+    return member.name[:MAX_DISPLAY_NAME] if member else f'(削除済み #{member_id})'
 
 # Autocomplete helper function for all member names
 async def all_member_autocomplete(interaction: discord.Interaction, current: str):
     """
     Helper function to generate autocomplete choices for all member names.
     """
-    members = [p['name'] for p in OVERALL_RANKS]
     return [
         app_commands.Choice(name=member, value=member)
-        for member in members if current.lower() in member.lower()
-    ][:25]
+        for member in (await get_shard(interaction)).name_index.search(current, 25)
+    ]
+
+def command_fingerprint(guild=None):
+    """
+    Helper function to hash the serialized schema of the slash commands (as sent to Discord on sync).
+    """
+    schema = [command.to_dict(bot.tree) for command in bot.tree.get_commands(guild=guild)]
+    schema.sort(key=lambda command: (command.get('type', 1), command['name']))
+    return hashlib.sha256(json.dumps(schema, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+async def sync_commands():
+    """
+    Syncs the slash commands (globally, or to DEV_GUILD_ID) only if their schema differs from the one
+    synced last time, and at most once per process. Gateway reconnects no longer trigger a sync.
+    """
+    global commands_synced
+    if commands_synced:
+        return
+    commands_synced = True
+
+    guild = discord.Object(id=DEV_GUILD_ID) if DEV_GUILD_ID else None
+    if guild is not None:
+        bot.tree.copy_global_to(guild=guild)
+    fingerprint = command_fingerprint(guild)
+    key = f'command_fingerprint:{bot.application_id}:{DEV_GUILD_ID or "global"}'
+    if not FORCE_COMMAND_SYNC and await asyncio.to_thread(STORAGE.get_meta, key) == fingerprint:
+        logger.info('コマンドに変更がないため、同期をスキップしました。')
+        return
+
+    try:
+        logger.info('コマンドの同期を開始します...')
+        synced = await bot.tree.sync(guild=guild)
+        logger.info('%d 個のコマンドを同期しました。', len(synced))
+    except Exception as e:
+        logger.exception('コマンドの同期中にエラーが発生しました: %s', e)
+        return
+    await asyncio.to_thread(STORAGE.set_meta, key, fingerprint)
+
+@bot.event
+async def setup_hook():
+    """Botの起動時に一度だけ実行される初期化処理"""
+    WATCHDOG.start(asyncio.get_running_loop())
+    flush_storage.start()
+    sync_shards.start()
+    reload_seed.start()
+    evict_idle_shards.start()
+    dump_metrics.start()
+    publish_health.start()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+    except NotImplementedError:
+        pass
+    # Sync slash commands with Discord (only when they changed)
+    await sync_commands()
 
 @bot.event
 async def on_ready():
     """Botが起動したときに実行されるイベントハンドラ"""
-    print(f'{bot.user.name} が正常に起動しました！')
-    
-    # Sync slash commands with Discord
-    try:
-        print("コマンドの同期を開始します...")
-        synced = await bot.tree.sync()
-        print(f'{len(synced)} 個のコマンドを同期しました。')
-    except Exception as e:
-        print(f'コマンドの同期中にエラーが発生しました: {e}')
-    
-    print('------')
+    logger.info('%s が正常に起動しました！', bot.user.name)
+
+@bot.event
+async def on_member_update(before, after):
+    """Drops the cached roster mapping of a member whose nickname changed"""
+    shard = SHARDS.loaded(after.guild.id)
+    if shard is not None and before.nick != after.nick:
+        shard.attendance.forget(after.id)
+
+@bot.event
+async def on_member_remove(member):
+    shard = SHARDS.loaded(member.guild.id)
+    if shard is not None:
+        shard.attendance.forget(member.id)
+
+@bot.event
+async def on_user_update(before, after):
+    """Drops the cached roster mappings of a user whose user name or global name changed"""
+    if before.name != after.name or before.global_name != after.global_name:
+        for shard in SHARDS:
+            shard.attendance.forget(after.id)
+
+@bot.event
+async def on_raw_reaction_add(payload):
+    if payload.message_id in SIGNUPS and str(payload.emoji) == SIGNUP_EMOJI and payload.user_id != bot.user.id:
+        SIGNUPS.add(payload.message_id, payload.user_id)
+
+@bot.event
+async def on_raw_reaction_remove(payload):
+    if payload.message_id in SIGNUPS and str(payload.emoji) == SIGNUP_EMOJI:
+        SIGNUPS.remove(payload.message_id, payload.user_id)
 
 @bot.tree.command(name='add_member', description='新しいメンバーを戦力リストに追加します。')
 @app_commands.describe(member_name='追加するメンバーの名前', profession='メンバーの職業 (剣士, 騎士, 魔導士, 賢者)', power='メンバーの戦力値')
+@instrumented
 async def add_member(interaction: discord.Interaction, member_name: str, profession: str, power: int):
     """
     Adds a new member to the power list.
     """
+    shard = await get_shard(interaction)
     if profession not in PROFESSIONS:
         await interaction.response.send_message(f'無効な職業です。利用可能な職業: {", ".join(PROFESSIONS.keys())}')
         return
 
-    if any(p['name'] == member_name for p in OVERALL_RANKS):
+    if member_name in shard.roster:
         await interaction.response.send_message(f'`{member_name}`さんはすでに登録されています。')
         return
 
-    new_member = {'name': member_name, 'profession': profession, 'power': power}
-    OVERALL_RANKS.append(new_member)
-    rebuild_player_ranks()
+    shard.roster.add(member_name, profession, power)
 
     await interaction.response.send_message(f'`{member_name}`さん ({profession}, 戦力: {power})を戦力リストに追加しました。')
 
 @bot.tree.command(name='remove_member', description='戦力リストからメンバーを削除します。')
 @app_commands.describe(member_name='削除するメンバーの名前')
 @app_commands.autocomplete(member_name=all_member_autocomplete)
+@instrumented
 async def remove_member(interaction: discord.Interaction, member_name: str):
     """
     Removes a member from the power list.
     """
-    global OVERALL_RANKS
-    
-    member_to_remove = next((p for p in OVERALL_RANKS if p['name'] == member_name), None)
-
-    if member_to_remove:
-        OVERALL_RANKS.remove(member_to_remove)
-        rebuild_player_ranks()
+    shard = await get_shard(interaction)
+    if member_name in shard.roster:
+        shard.roster.remove(member_name)
         await interaction.response.send_message(f'`{member_name}`さんを戦力リストから削除しました。')
     else:
         await interaction.response.send_message(f'`{member_name}`さんは戦力リストに見つかりませんでした。')
@@ -173,118 +506,182 @@ async def remove_member(interaction: discord.Interaction, member_name: str):
 @bot.tree.command(name='rename_member', description='メンバーの名前を変更します。')
 @app_commands.describe(old_name='変更前のメンバーの名前', new_name='新しいメンバーの名前')
 @app_commands.autocomplete(old_name=all_member_autocomplete)
+@instrumented
 async def rename_member(interaction: discord.Interaction, old_name: str, new_name: str):
     """
     Changes a member's name.
     """
-    member_to_rename = next((p for p in OVERALL_RANKS if p['name'] == old_name), None)
-
-    if not member_to_rename:
+    shard = await get_shard(interaction)
+    if old_name not in shard.roster:
         await interaction.response.send_message(f'`{old_name}`さんは戦力リストに見つかりませんでした。')
         return
 
-    if any(p['name'] == new_name for p in OVERALL_RANKS):
+    if new_name in shard.roster:
         await interaction.response.send_message(f'`{new_name}`はすでに他のメンバーが使用しています。')
         return
     
-    member_to_rename['name'] = new_name
-    
-    if old_name in LEADER_CANDIDATES:
-        LEADER_CANDIDATES[LEADER_CANDIDATES.index(old_name)] = new_name
+    shard.roster.rename(old_name, new_name)
     
-    user_id = interaction.user.id
-    if user_id in excluded_members and old_name in excluded_members[user_id]:
-        excluded_members[user_id].remove(old_name)
-        excluded_members[user_id].append(new_name)
-    
-    if user_id in carried_members and old_name in carried_members[user_id]:
-        carried_members[user_id].remove(old_name)
-        carried_members[user_id].append(new_name)
-            
-    if user_id in fixed_teams and old_name in fixed_teams[user_id]['members']:
-        fixed_teams[user_id]['members'].remove(old_name)
-        fixed_teams[user_id]['members'].append(new_name)
-            
-    if user_id in preferred_members and old_name in preferred_members[user_id]:
-        preferred_members[user_id].remove(old_name)
-        preferred_members[user_id].append(new_name)
-
-    rebuild_player_ranks()
+    # Selection states refer to members by id, so only the leader candidates (names) need updating
+    if old_name in shard.leader_candidates:
+        shard.leader_candidates[shard.leader_candidates.index(old_name)] = new_name
+    shard.save_leader_candidates()
 
     await interaction.response.send_message(f'メンバー名 `{old_name}` を `{new_name}` に変更しました。')
 
 @bot.tree.command(name='set_power', description='メンバーの戦力値を変更します。')
 @app_commands.describe(member_name='戦力値を変更するメンバーの名前', new_power='新しい戦力値')
 @app_commands.autocomplete(member_name=all_member_autocomplete)
+@instrumented
 async def set_power(interaction: discord.Interaction, member_name: str, new_power: int):
     """
     Changes a member's power value.
     """
-    member_to_update = next((p for p in OVERALL_RANKS if p['name'] == member_name), None)
-
-    if not member_to_update:
+    shard = await get_shard(interaction)
+    if member_name not in shard.roster:
         await interaction.response.send_message(f'`{member_name}`さんは戦力リストに見つかりませんでした。')
         return
 
-    member_to_update['power'] = new_power
-    rebuild_player_ranks()
+    shard.roster.set_power(member_name, new_power)
 
     await interaction.response.send_message(f'`{member_name}`さんの戦力値を `{new_power}` に変更しました。')
 
+@bot.tree.command(name='import_roster', description='CSV/JSONファイルからメンバーをまとめて登録・更新します。')
+@app_commands.describe(
+    file='name, profession, power の列を持つCSV、またはそれらのキーを持つオブジェクトの配列のJSON',
+    replace='ファイルに含まれないメンバーを削除します (デフォルトはFalse)',
+    dry_run='変更を適用せず、差分だけを表示します (デフォルトはFalse)'
+)
+@instrumented
+async def import_roster(interaction: discord.Interaction, file: discord.Attachment, replace: bool = False, dry_run: bool = False):
+    """
+    Adds and updates members from an uploaded CSV/JSON file. The whole file is validated first;
+    the changes are then applied to the roster in one batch and written in a single transaction.
+    """
+    shard = await get_shard(interaction)
+    if file.size > MAX_IMPORT_BYTES:
+        await interaction.response.send_message(f'ファイルが大きすぎます (上限 {MAX_IMPORT_BYTES // 1024}KB)。')
+        return
+    await interaction.response.defer()
+    mark_deferred()
+
+    try:
+        rows = read_rows(await file.read(), file.filename)
+        records = validate_rows(rows, PROFESSIONS, shard.name_index)
+    except RosterImportError as e:
+        lines = [f'⚠️ インポートできませんでした ({len(e.errors)}件の問題):']
+        lines.extend(f'- {error}' for error in e.errors[:MAX_IMPORT_DETAILS])
+        if len(e.errors) > MAX_IMPORT_DETAILS:
+            lines.append(f'...ほか{len(e.errors) - MAX_IMPORT_DETAILS}件')
+        await send_text(interaction.followup.send, '\n'.join(lines))
+        return
+
+    added, updated, unchanged, removed = diff_roster(shard.roster, records, replace)
+    if not dry_run:
+        shard.roster.apply_batch(
+            [(record['name'], record['profession'], record['power']) for record in added + [new for _, new in updated]],
+            [record['name'] for record in removed]
+        )
+        await asyncio.to_thread(STORAGE.flush)
+
+    lines = [
+        f'**📥 ロスターのインポート{" (ドライラン: 変更は適用されていません)" if dry_run else ""}**',
+        f'追加: {len(added)}人 / 更新: {len(updated)}人 / 変更なし: {len(unchanged)}人 / 削除: {len(removed)}人'
+    ]
+    details = (
+        [f'+ {record["name"][:MAX_DISPLAY_NAME]} ({record["profession"]}, 戦力: {record["power"]})' for record in added]
+        + [
+            f'~ {new["name"][:MAX_DISPLAY_NAME]} ({old["profession"]}, 戦力: {old["power"]} → {new["profession"]}, 戦力: {new["power"]})'
+            for old, new in updated
+        ]
+        + [f'- {record["name"][:MAX_DISPLAY_NAME]}' for record in removed]
+    )
+    if details:
+        lines.append('```diff')
+        lines.extend(details[:MAX_IMPORT_DETAILS])
+        if len(details) > MAX_IMPORT_DETAILS:
+            lines.append(f'...ほか{len(details) - MAX_IMPORT_DETAILS}件')
+        lines.append('```')
+    await send_text(interaction.followup.send, '\n'.join(lines))
+
+@bot.tree.command(name='export_roster', description='戦力リストをCSV/JSONファイルとして出力します。')
+@app_commands.describe(file_format='出力形式 (デフォルトはCSV)')
+@app_commands.choices(file_format=[
+    app_commands.Choice(name='CSV', value='csv'),
+    app_commands.Choice(name='JSON', value='json')
+])
+@instrumented
+async def export_roster(interaction: discord.Interaction, file_format: str = 'csv'):
+    """
+    Sends the roster as a CSV/JSON attachment, written member by member to a spooled temporary file.
+    """
+    shard = await get_shard(interaction)
+    await interaction.response.defer()
+    mark_deferred()
+    # The member list is snapshotted here; the file itself is written on a worker thread
+    members = iter(shard.roster)
+    count = len(shard.roster)
+    with await asyncio.to_thread(write_roster, members, file_format) as fp:
+        await interaction.followup.send(
+            f'{count}人のメンバーを出力しました。',
+            file=discord.File(fp, filename=f'roster.{file_format}')
+        )
+
 @bot.tree.command(name='member_list', description='すべてのメンバーと詳細な情報を表示します。')
+@instrumented
 async def member_list(interaction: discord.Interaction):
     """
     Displays a list of all registered members with their details.
     """
-    message = '**メンバーリスト**\n'
-    for i, member in enumerate(OVERALL_RANKS):
-        message += f'{i + 1}. 名前: {member["name"]}, 職業: {member["profession"]}, 戦力: {member["power"]}\n'
-    await interaction.response.send_message(message)
+    shard = await get_shard(interaction)
+    def render_page(page):
+        start = page * MEMBERS_PER_PAGE
+        lines = ['**メンバーリスト**']
+        for i, member in enumerate(shard.roster.slice(start, start + MEMBERS_PER_PAGE), start=start):
+            lines.append(f'{i + 1}. 名前: {member.name[:MAX_DISPLAY_NAME]}, 職業: {member.profession}, 戦力: {member.power}')
+        return '\n'.join(lines)
+
+    page_count = max(1, -(-len(shard.roster) // MEMBERS_PER_PAGE))
+    await send_paginated(interaction.response.send_message, render_page, page_count)
 
 @bot.tree.command(name='set_carried', description='特定のメンバーをキャリー対象として設定します。')
 @app_commands.describe(member_names='キャリー対象に設定するメンバーの名前 (スペース区切り)')
+@instrumented
 async def set_carried(interaction: discord.Interaction, member_names: str):
     """
     Sets one or more members as "carried" members.
     """
+    shard = await get_shard(interaction)
     user_id = interaction.user.id
-    if user_id not in carried_members:
-        carried_members[user_id] = []
-
-    added_members = []
-    not_found_members = []
-    
-    names_list = member_names.split()
-
-    for member_name in names_list:
-        if member_name not in [p['name'] for p in OVERALL_RANKS]:
-            not_found_members.append(member_name)
-        elif member_name in carried_members[user_id]:
-            pass
-        else:
-            carried_members[user_id].append(member_name)
-            added_members.append(member_name)
+    added_members, not_found_members, conflicts = await add_to_selection(shard, user_id, 'carried', member_names.split())
     
     message = ''
     if added_members:
         message += f'`{", ".join(added_members)}`さんをキャリー対象に設定しました。\n'
     
     if not_found_members:
-        message += f'⚠️ 登録されていないメンバー: `{", ".join(not_found_members)}`'
+        message += f'⚠️ 登録されていないメンバー: `{", ".join(not_found_members)}`\n'
+    message += format_conflicts(conflicts)
 
     if not message:
         message = '指定されたメンバーはすべてすでにキャリー対象に設定されています。'
 
+    shard.save_user_state(user_id)
+
     await interaction.response.send_message(message)
 
 @bot.tree.command(name='clear_carried', description='キャリー対象メンバーリストをリセットします。')
+@instrumented
 async def clear_carried(interaction: discord.Interaction):
     """
     Resets the list of carried members.
     """
+    shard = await get_shard(interaction)
     user_id = interaction.user.id
-    if user_id in carried_members:
-        carried_members[user_id] = []
+    selection = await shard.selections.get(user_id)
+    if selection.carried:
+        selection.clear('carried')
+        shard.save_user_state(user_id)
         await interaction.response.send_message('キャリー対象メンバーリストをリセットしました。')
     else:
         await interaction.response.send_message('キャリー対象メンバーリストはすでに空です。')
@@ -292,104 +689,84 @@ async def clear_carried(interaction: discord.Interaction):
 @bot.tree.command(name='swap_power', description='指定された2人のメンバーの戦力値を交換します。')
 @app_commands.describe(member1='1人目のメンバー', member2='2人目のメンバー')
 @app_commands.autocomplete(member1=all_member_autocomplete, member2=all_member_autocomplete)
+@instrumented
 async def swap_power(interaction: discord.Interaction, member1: str, member2: str):
     """
     Swaps the power values of two specified members.
     """
+    shard = await get_shard(interaction)
     member1_name = member1
     member2_name = member2
 
-    member1_data = next((p for p in OVERALL_RANKS if p['name'] == member1_name), None)
-    member2_data = next((p for p in OVERALL_RANKS if p['name'] == member2_name), None)
+    member1_data = shard.roster.get(member1_name)
+    member2_data = shard.roster.get(member2_name)
 
     if not member1_data or not member2_data:
         await interaction.response.send_message('指定されたメンバーが見つかりません。フルネームを正しく入力してください。')
         return
 
-    member1_power = member1_data['power']
-    member2_power = member2_data['power']
-    member1_data['power'] = member2_power
-    member2_data['power'] = member1_power
-
-    rebuild_player_ranks()
+    member1_power = member1_data.power
+    member2_power = member2_data.power
+    shard.roster.set_power(member1_name, member2_power)
+    shard.roster.set_power(member2_name, member1_power)
 
     await interaction.response.send_message(f'{member1_name}さん（戦力: {member1_power}）と{member2_name}さん（戦力: {member2_power}）の戦力値を交換しました。')
 
 @bot.tree.command(name='exclude_member', description='グループ自動選出から除外するメンバーを設定します。')
 @app_commands.describe(member_names='除外するメンバーの名前 (スペース区切り)')
+@instrumented
 async def exclude_member(interaction: discord.Interaction, member_names: str):
     """
     Sets one or more members to be excluded from auto group selection.
     """
+    shard = await get_shard(interaction)
     user_id = interaction.user.id
-    if user_id not in excluded_members:
-        excluded_members[user_id] = []
-
-    added_members = []
-    not_found_members = []
-    
-    names_list = member_names.split()
-    
-    for member_name in names_list:
-        if member_name not in [p['name'] for p in OVERALL_RANKS]:
-            not_found_members.append(member_name)
-        elif member_name in excluded_members[user_id]:
-            pass
-        else:
-            excluded_members[user_id].append(member_name)
-            added_members.append(member_name)
+    added_members, not_found_members, conflicts = await add_to_selection(shard, user_id, 'excluded', member_names.split())
     
     message = ''
     if added_members:
         message += f'`{", ".join(added_members)}`さんを自動選出から除外しました。\n'
     
     if not_found_members:
-        message += f'⚠️ 登録されていないメンバー: `{", ".join(not_found_members)}`'
+        message += f'⚠️ 登録されていないメンバー: `{", ".join(not_found_members)}`\n'
+    message += format_conflicts(conflicts)
     
     if not message:
         message = '指定されたメンバーはすべてすでに除外リストにいます。'
-        
+
+    shard.save_user_state(user_id)
     await interaction.response.send_message(message)
 
 @bot.tree.command(name='clear_excluded', description='自動選出の除外メンバーリストをリセットします。')
+@instrumented
 async def clear_excluded(interaction: discord.Interaction):
     """
     Resets the list of excluded members.
     """
+    shard = await get_shard(interaction)
     user_id = interaction.user.id
-    if user_id in excluded_members:
-        excluded_members[user_id] = []
+    selection = await shard.selections.get(user_id)
+    if selection.excluded:
+        selection.clear('excluded')
+        shard.save_user_state(user_id)
         await interaction.response.send_message('除外メンバーリストをリセットしました。すべてのメンバーが自動選出の対象になりました。')
     else:
         await interaction.response.send_message('除外メンバーリストはすでに空です。')
         
 @bot.tree.command(name='fix_team', description='指定したメンバーをチームに固定し、特定のメンバーを優先的に追加します。')
 @app_commands.describe(fixed_names='チームに固定するメンバーの名前 (スペース区切り)', preferred_names='固定チームに優先的に追加するメンバーの名前 (スペース区切り)', fixed_probability='固定メンバーがチームに含まれる確率 (0.0 から 1.0 の間, デフォルトは 1.0)')
+@instrumented
 async def fix_team(interaction: discord.Interaction, fixed_names: str, preferred_names: str = None, fixed_probability: float = 1.0):
     """
     Sets one or more members to be "fixed" in a team, with optional preferred members.
     """
+    shard = await get_shard(interaction)
     user_id = interaction.user.id
-    if user_id not in fixed_teams:
-        fixed_teams[user_id] = {'members': [], 'probability': 1.0}
-    if user_id not in preferred_members:
-        preferred_members[user_id] = []
-
-    added_fixed = []
-    not_found_fixed = []
-    fixed_list = fixed_names.split()
     
     # Update fixed probability
-    fixed_teams[user_id]['probability'] = fixed_probability
+    (await shard.selections.get(user_id)).fixed_probability = fixed_probability
     
-    for name in fixed_list:
-        if name not in [p['name'] for p in OVERALL_RANKS]:
-            not_found_fixed.append(name)
-        elif name in fixed_teams[user_id]['members']:
-            pass
-        else:
-            fixed_teams[user_id]['members'].append(name)
-            added_fixed.append(name)
+    added_fixed, not_found_fixed, conflicts = await add_to_selection(shard, user_id, 'fixed', fixed_names.split())
             
     message = ''
     if added_fixed:
@@ -399,355 +776,441 @@ async def fix_team(interaction: discord.Interaction, fixed_names: str, preferred
         message += f'⚠️ 登録されていない固定メンバー: `{", ".join(not_found_fixed)}`\n'
     
     if preferred_names:
-        added_preferred = []
-        not_found_preferred = []
-        preferred_list = preferred_names.split()
-        for name in preferred_list:
-            if name not in [p['name'] for p in OVERALL_RANKS]:
-                not_found_preferred.append(name)
-            elif name in preferred_members[user_id]:
-                pass
-            else:
-                preferred_members[user_id].append(name)
-                added_preferred.append(name)
+        added_preferred, not_found_preferred, preferred_conflicts = await add_to_selection(shard, user_id, 'preferred', preferred_names.split())
+        conflicts += preferred_conflicts
         
         if added_preferred:
             message += f'`{", ".join(added_preferred)}`さんを固定チームに優先的に追加するように設定しました。\n'
         if not_found_preferred:
-            message += f'⚠️ 登録されていない優先メンバー: `{", ".join(not_found_preferred)}`'
+            message += f'⚠️ 登録されていない優先メンバー: `{", ".join(not_found_preferred)}`\n'
+    message += format_conflicts(conflicts)
     
     if not message:
         message = '指定されたメンバーはすべてすでにチームに固定または優先設定されています。'
-        
+
+    shard.save_user_state(user_id)
     await interaction.response.send_message(message)
 
 @bot.tree.command(name='clear_fixed', description='チーム固定メンバーと優先メンバーリストをリセットします。')
+@instrumented
 async def clear_fixed(interaction: discord.Interaction):
     """
     Resets the list of fixed members.
     """
+    shard = await get_shard(interaction)
     user_id = interaction.user.id
-    if user_id in fixed_teams:
-        fixed_teams[user_id] = {'members': [], 'probability': 1.0}
-    if user_id in preferred_members:
-        preferred_members[user_id] = []
+    selection = await shard.selections.get(user_id)
+    selection.clear('fixed')
+    selection.clear('preferred')
+    selection.fixed_probability = 1.0
+    shard.save_user_state(user_id)
     
     await interaction.response.send_message('チーム固定メンバーと優先メンバーリストをリセットしました。')
 
 @bot.tree.command(name='check_available', description='グループ編成に参加可能なメンバー数を確認します。')
+@instrumented
 async def check_available(interaction: discord.Interaction):
     """
     Displays the total number of members available for group formation.
     """
-    user_id = interaction.user.id
-    excluded_list = excluded_members.get(user_id, [])
-    fixed_list = fixed_teams.get(user_id, {'members': [], 'probability': 1.0})['members']
-    preferred_list = preferred_members.get(user_id, [])
+    shard = await get_shard(interaction)
+    selection = await shard.selections.get(interaction.user.id)
     
-    fixed_and_preferred = set(fixed_list) | set(preferred_list)
-    
-    available_members = [
-        p for p in OVERALL_RANKS
-        if p['name'] not in excluded_list and p['name'] not in fixed_and_preferred
-    ]
-    
-    total_involved = len(fixed_list) + len(preferred_list) + len(available_members)
+    # A member is in at most one selection category, so the roster minus every selected member
+    # is the available count (carried members are counted, as before)
+    unavailable = sum(1 for member_id in [*selection.excluded, *selection.fixed, *selection.preferred] if shard.roster.by_id(member_id))
+    available_count = len(shard.roster) - unavailable
     
     await interaction.response.send_message(
-        f'現在、グループ編成に参加可能なメンバーは**{len(available_members)}人**です。\n'
+        f'現在、グループ編成に参加可能なメンバーは**{available_count}人**です。\n'
         f'(固定メンバーと優先メンバーは含まれません)'
     )
 
 
+@bot.tree.command(name='start_signup', description='リアクションで参加者を募る参加受付メッセージを投稿します。')
+@app_commands.describe(title='参加受付のタイトル (省略可)')
+@app_commands.guild_only()
+@instrumented
+async def start_signup(interaction: discord.Interaction, title: str = None):
+    """
+    Posts a sign-up message; auto_create_group with attendance=signup uses the users who reacted to the latest one.
+    """
+    await interaction.response.send_message(
+        (f'**📣 {title}**\n' if title else '**📣 参加受付**\n')
+        + f'参加する人はこのメッセージに {SIGNUP_EMOJI} でリアクションしてください。'
+    )
+    message = await interaction.original_response()
+    SIGNUPS.register(message.id)
+    await message.add_reaction(SIGNUP_EMOJI)
+    await asyncio.to_thread(STORAGE.set_meta, f'signup:{interaction.guild_id}', f'{message.channel.id}:{message.id}')
+
+@bot.tree.command(name='link_member', description='Discordユーザーを戦力リストのメンバーと対応付けます。')
+@app_commands.describe(user='対応付けるDiscordユーザー', member_name='戦力リストのメンバーの名前 (省略すると対応付けを解除します)')
+@app_commands.autocomplete(member_name=all_member_autocomplete)
+@app_commands.guild_only()
+@instrumented
+async def link_member(interaction: discord.Interaction, user: discord.Member, member_name: str = None):
+    """
+    Links a Discord user to a roster member, for users whose display name does not match their member name.
+    """
+    shard = await get_shard(interaction)
+    if member_name is None:
+        shard.attendance.link(user.id, None)
+        await interaction.response.send_message(f'`{user.display_name}` さんの対応付けを解除しました。')
+        return
+    member = shard.roster.get(member_name)
+    if member is None:
+        await interaction.response.send_message(f'`{member_name}` さんはリストに登録されていません。')
+        return
+    shard.attendance.link(user.id, member.id)
+    await interaction.response.send_message(f'`{user.display_name}` さんを `{member_name}` さんと対応付けました。')
+
 @bot.tree.command(name='auto_create_group', description='自動的にメンバーを選出し、指定されたタイプのグループを作成します。')
 @app_commands.describe(
     group_type='グループのタイプ: balance, high_power, carry (デフォルトはbalance)',
     preferred_probability='固定チームに優先メンバーが追加される確率 (0.0 から 1.0 の間, デフォルトは 1.0)',
     max_sages='各チームの賢者の上限人数 (デフォルトは1)',
     max_knights='各チームの騎士の上限人数 (デフォルトは1)',
-    max_swordsmen='各チームの剣士の上限人数 (デフォルトは1)'
+    max_swordsmen='各チームの剣士の上限人数 (デフォルトは1)',
+    candidates='並列に生成する編成候補の数。最も評価の良い編成を表示します (デフォルトは1)',
+    alternatives='最良の編成に加えて表示する次点候補の数 (デフォルトは0)',
+    seed='乱数シード。同じシードと同じ条件なら同じ編成を再現します (省略時はランダム)',
+    attendance='参加者だけから選出します: voice (ボイスチャンネル), signup (参加受付のリアクション)',
+    voice_channel='attendance=voice で使うボイスチャンネル (省略時は実行者が参加中のチャンネル)'
 )
-async def auto_create_group(interaction: discord.Interaction, group_type: str = 'balance', preferred_probability: float = 1.0, max_sages: int = 1, max_knights: int = 1, max_swordsmen: int = 1):
-    print("--- Debug Log: auto_create_group command started ---")
+@app_commands.choices(attendance=[
+    app_commands.Choice(name='ボイスチャンネル', value='voice'),
+    app_commands.Choice(name='参加受付', value='signup')
+])
+@instrumented
+async def auto_create_group(interaction: discord.Interaction, group_type: str = 'balance', preferred_probability: float = 1.0, max_sages: int = 1, max_knights: int = 1, max_swordsmen: int = 1, candidates: int = 1, alternatives: int = 0, seed: int = None, attendance: str = None, voice_channel: discord.VoiceChannel = None):
+    shard = await get_shard(interaction)
     await interaction.response.defer()
+    mark_deferred()
     
     user_id = interaction.user.id
-    excluded_list = excluded_members.get(user_id, [])
-    carried_list = carried_members.get(user_id, [])
-    
-    fixed_team_data = fixed_teams.get(user_id, {'members': [], 'probability': 1.0})
-    fixed_list = fixed_team_data['members']
-    fixed_probability = fixed_team_data['probability']
-    preferred_list = preferred_members.get(user_id, [])
-
-    print(f"User ID: {user_id}")
-    print(f"Exclusion List: {excluded_list}")
-    print(f"Carried List: {carried_list}")
-    print(f"Fixed Team List: {fixed_list} (Probability: {fixed_probability})")
-    print(f"Preferred Members List: {preferred_list}")
-    
-    team1_members = []
-    other_members = []
-    
-    for member_name in fixed_list:
-        member = next((p for p in OVERALL_RANKS if p['name'] == member_name), None)
-        if member and random.random() < fixed_probability:
-            team1_members.append(member)
-        elif member:
-            other_members.append(member)
-            
-    for member_name in preferred_list:
-        member = next((p for p in OVERALL_RANKS if p['name'] == member_name), None)
-        if member and random.random() < preferred_probability:
-            team1_members.append(member)
-        elif member:
-            other_members.append(member)
-            
-    processed_names = set(m['name'] for m in team1_members) | set(m['name'] for m in other_members) | set(excluded_list)
-    available_members = [p for p in OVERALL_RANKS if p['name'] not in processed_names]
-    available_members.extend(other_members)
-    random.shuffle(available_members)
-    
-    num_total_members = len(team1_members) + len(available_members)
-    print(f"Number of total members: {num_total_members}")
-    
-    if num_total_members < 3 and len(team1_members) < 3:
-        await interaction.followup.send(
-            f'⚠️ グループを作成するには最低3人のメンバーが必要です。現在参加可能なメンバーは**{num_total_members}人**です。\n'
-            f'`/member_list`コマンドでメンバーを確認してください。'
-        )
-        return
+    selection_state = await shard.selections.get(user_id)
+    excluded_list = selection_state.names('excluded', shard.roster)
+    carried_list = selection_state.names('carried', shard.roster)
+    fixed_list = selection_state.names('fixed', shard.roster)
+    fixed_probability = selection_state.fixed_probability
+    preferred_list = selection_state.names('preferred', shard.roster)
+
+    logger.debug(
+        'auto_create_group: user=%s excluded=%s carried=%s fixed=%s (probability %s) preferred=%s',
+        user_id, excluded_list, carried_list, fixed_list, fixed_probability, preferred_list
+    )
 
-    final_teams = []
-    message_header = ''
+    if group_type not in GROUP_TYPE_HEADERS:
+        await interaction.followup.send(f'無効なグループタイプです。`balance`, `high_power`, `carry`から選択してください。')
+        return
 
-    if team1_members:
-        final_teams.append(team1_members)
+    # Attendance mode: only the attending members are candidates, and selections of absent members are ignored
+    attendee_ids = None
+    unmatched = []
+    if attendance is not None:
+        try:
+            attendees, unmatched = await collect_attendance(interaction, shard, attendance, voice_channel)
+        except AttendanceError as e:
+            await interaction.followup.send(str(e))
+            return
+        attendee_ids = frozenset(member.id for member in attendees)
+        present = {member.name for member in attendees}
+        carried_list = [name for name in carried_list if name in present]
+        fixed_list = [name for name in fixed_list if name in present]
+        preferred_list = [name for name in preferred_list if name in present]
 
     if carried_list and group_type != 'carry':
         await interaction.followup.send(f'キャリー対象が設定されているため、グループタイプを`carry`に強制設定します。')
         group_type = 'carry'
 
-    if group_type == 'carry':
-        message_header = '**🤖 自動グループ編成結果 (キャリー型)**\n\n'
-        
-        if not carried_list or not any(m['name'] == carried_list[0] for m in available_members):
-            await interaction.followup.send(f'指定されたキャリーメンバー `{carried_list[0] if carried_list else ""}` が参加可能メンバーリストに見つかりませんでした。')
-            return
-            
-        carried_member = next(m for m in available_members if m['name'] == carried_list[0])
-        remaining_members = [m for m in available_members if m['name'] != carried_list[0]]
-        remaining_members.sort(key=lambda x: x['power'], reverse=True)
+    candidates = max(1, min(candidates, MAX_GROUPING_CANDIDATES))
 
-        if len(remaining_members) < 3:
-            await interaction.followup.send(f'キャリーチームを編成するには、{len(remaining_members)}人ではメンバーが不足しています。')
+    # Only seeded calls are reproducible, so only they are served from the cache
+    cache_key = None
+    if seed is not None:
+        selection = (
+            tuple(selection_state.excluded), tuple(selection_state.carried), tuple(selection_state.fixed),
+            fixed_probability, tuple(selection_state.preferred)
+        )
+        attendance_key = (tuple(sorted(attendee_ids)), tuple(sorted(unmatched))) if attendee_ids is not None else None
+        cache_key = (shard.roster.version, selection, attendance_key, group_type, preferred_probability, max_sages, max_knights, max_swordsmen, candidates, alternatives, seed)
+        cached = shard.cache.get(cache_key)
+        if cached is not None:
+            messages, grouping = cached
+            if grouping is not None:
+                shard.save_grouping(interaction.channel_id, grouping)
+            for message in messages:
+                await send_text(interaction.followup.send, message)
             return
+    else:
+        seed = random.randrange(2 ** 32)
 
-        top_players_pool = remaining_members[:10]
-        if len(top_players_pool) < 3:
-            top_3_members = top_players_pool
-        else:
-            top_3_members = random.sample(top_players_pool, 3)
+    # Results refer to members by id; they are resolved against this snapshot, not the live roster
+    roster_members = list(shard.roster)
+    if attendee_ids is not None:
+        roster_members = [member for member in roster_members if member.id in attendee_ids]
+    members_by_id = {member.id: member for member in roster_members}
 
-        remaining_members_for_balance = [m for m in remaining_members if m not in top_3_members]
-        
-        final_teams.append([carried_member] + top_3_members)
-        
-        teams_balance, leftover = create_groups(remaining_members_for_balance, 'balance', max_sages, max_knights, max_swordsmen)
-        final_teams.extend(teams_balance)
-        
-    elif group_type == 'balance':
-        message_header = '**🤖 自動グループ編成結果 (バランス型)**\n\n'
-        teams_balance, leftover = create_groups(available_members, 'balance', max_sages, max_knights, max_swordsmen)
-        final_teams.extend(teams_balance)
-        
-    elif group_type == 'high_power':
-        message_header = '**🤖 自動グループ編成結果 (高戦力型)**\n\n'
-        teams_high_power, leftover = create_groups(available_members, 'high_power', max_sages, max_knights, max_swordsmen)
-        final_teams.extend(teams_high_power)
-        
-    else:
-        await interaction.followup.send(f'無効なグループタイプです。`balance`, `high_power`, `carry`から選択してください。')
+    try:
+        with stage('create_groups'):
+            results = await run_grouping(
+                seed,
+                candidates=candidates,
+                roster_members=roster_members,
+                leader_candidates=list(shard.leader_candidates),
+                excluded_list=excluded_list,
+                carried_list=carried_list,
+                fixed_list=fixed_list,
+                fixed_probability=fixed_probability,
+                preferred_list=preferred_list,
+                preferred_probability=preferred_probability,
+                group_type=group_type,
+                max_sages=max_sages,
+                max_knights=max_knights,
+                max_swordsmen=max_swordsmen
+            )
+    except GroupingError as e:
+        if cache_key is not None:
+            shard.cache.put(user_id, cache_key, ([str(e)], None))
+        await interaction.followup.send(str(e))
         return
 
-    teams_with_leader = []
-    for team in final_teams:
-        leader = None
-        leader_candidates_in_team = [m for m in team if m['name'] in LEADER_CANDIDATES]
-        if leader_candidates_in_team:
-            leader = max(leader_candidates_in_team, key=lambda x: x['power'])
-        
-        team_members_without_leader = [m for m in team if m['name'] != (leader['name'] if leader else '')]
-        
-        teams_with_leader.append({
-            'members': team_members_without_leader,
-            'leader': leader
-        })
-
-    if not teams_with_leader:
+    if not results[0]['teams']:
         await interaction.followup.send("グループを編成できませんでした。")
         return
 
-    message = message_header
+    with stage('render'):
+        messages = []
+
+        message = GROUP_TYPE_HEADERS[group_type]
+        message += f'シード: `{seed}`' + (f' (候補数: {candidates})' if candidates > 1 else '') + '\n'
+        if attendee_ids is not None:
+            message += f'参加者: {len(attendee_ids)}人 ({"ボイスチャンネル" if attendance == "voice" else "参加受付"})\n'
+        if unmatched:
+            message += f'⚠️ 戦力リストと対応付けられなかった参加者: `{", ".join(unmatched[:MAX_IMPORT_DETAILS])}`' + (' ほか' if len(unmatched) > MAX_IMPORT_DETAILS else '') + ' (`/link_member` で対応付けできます)\n'
+        if results[0].get('fallback'):
+            message += '⚠️ **注意:** 計算が時間内に終わらなかったため簡易編成の結果です。同じシードでも再現されない場合があります。\n'
+        elif results[0].get('partial'):
+            message += '⚠️ **注意:** 一部の候補の計算が時間内に終わらなかったため、同じシードでも再現されない場合があります。\n'
+        elif any(result['time_limited'] for result in results):
+            message += '⚠️ **注意:** 計算が制限時間で打ち切られたため、同じシードでも再現されない場合があります。\n'
+        message += '\n'
+        if candidates > 1:
+            message += f'{len(results)}個の候補から最も評価の良い編成を選びました。({format_score(results[0]["score"])})\n\n'
+        message += render_groups(results[0], members_by_id, max_sages, max_knights, max_swordsmen)
+        messages.append(message)
+
+        for rank, result in enumerate(results[1:1 + max(0, alternatives)], start=2):
+            message = f'**📋 候補 {rank}** ({format_score(result["score"])})\n\n'
+            message += render_groups(result, members_by_id, max_sages, max_knights, max_swordsmen)
+            messages.append(message)
+
+    # Kept per channel, so that /regroup can repair it when members join or leave
+    grouping = {
+        'teams': results[0]['teams'],
+        'leftover': results[0]['leftover'],
+        'pinned': results[0]['pinned'],
+        'group_type': group_type,
+        'max_sages': max_sages,
+        'max_knights': max_knights,
+        'max_swordsmen': max_swordsmen,
+        'seed': seed
+    }
+    shard.save_grouping(interaction.channel_id, grouping)
+
+    # Results that depend on timing would not be reproduced by the same seed, so they are not cached
+    reproducible = not results[0].get('fallback') and not results[0].get('partial') and not any(result['time_limited'] for result in results)
+    if cache_key is not None and reproducible:
+        shard.cache.put(user_id, cache_key, (messages, grouping))
+
+    with stage('discord_api'):
+        for message in messages:
+            await send_text(interaction.followup.send, message)
+
+def format_score(score):
+    """
+    Helper function to summarize a grouping score for display.
+    """
+    return (
+        f'スコア: {score["total"]:.1f}, 戦力の標準偏差: {score["power_stdev"]:.0f}, '
+        f'上限超過: {score["violations"]}, 前衛/ヒーラー不足: {score["missing_roles"]}, リーダー未決定: {score["leaderless"]}'
+    )
+
+def render_groups(result, members_by_id, max_sages, max_knights, max_swordsmen):
+    """
+    Helper function to build the message body for a form_groups result.
+    """
+    teams_with_leader = result['teams']
+    leftover = result['leftover']
+
+    lines = []
     for i, team_data in enumerate(teams_with_leader):
-        leader = team_data['leader']
-        members = team_data['members']
+        leader = members_by_id[team_data['leader']] if team_data['leader'] is not None else None
+        members = [members_by_id[member_id] for member_id in team_data['members']]
         
         members_list = members[:]
         if leader:
             members_list.append(leader)
         
-        team_power_total = sum(m['power'] for m in members_list)
-        members_str = ', '.join([f'{m["name"]} ({m["profession"]})' for m in members_list])
+        team_power_total = sum(m.power for m in members_list)
+        members_str = ', '.join([f'{m.name} ({m.profession})' for m in members_list])
+
+        lines.append(f'**=== チーム {i + 1} ===**')
+        if leader:
+            lines.append(f'リーダー: **{leader.name}** ({leader.profession})')
+        else:
+            lines.append(f'リーダー: **未決定**')
+            lines.append('⚠️ **注意:** リーダー候補がいなかったためリーダーが自動設定されませんでした。')
 
-        team_size_warning = ''
         if len(members_list) < 4:
-            team_size_warning = f'⚠️ **注意:** このチームは{len(members_list)}人組です。\n'
+            lines.append(f'⚠️ **注意:** このチームは{len(members_list)}人組です。')
         if len(members_list) > 4:
             # This case should not happen with the new logic, but kept for safety.
-            team_size_warning += '⚠️ **注意:** このチームは4人を超えています。\n'
+            lines.append('⚠️ **注意:** このチームは4人を超えています。')
 
-        front_liners_count = sum(1 for m in members_list if PROFESSIONS[m['profession']] == '前衛')
-        warning_message = ''
+        front_liners_count = sum(1 for m in members_list if PROFESSIONS[m.profession] == '前衛')
         if front_liners_count == 0:
-            warning_message = '⚠️ **注意:** このチームには前衛メンバー (剣士/騎士) がいません。\n'
+            lines.append('⚠️ **注意:** このチームには前衛メンバー (剣士/騎士) がいません。')
 
-        healer_count = sum(1 for m in members_list if m['profession'] == '賢者')
+        healer_count = sum(1 for m in members_list if m.profession == '賢者')
         if healer_count == 0:
-            warning_message += '⚠️ **注意:** このチームにはヒーラーがいません。\n'
+            lines.append('⚠️ **注意:** このチームにはヒーラーがいません。')
             
-        role_warnings = ''
-        sage_count = sum(1 for m in members_list if m['profession'] == '賢者')
-        knight_count = sum(1 for m in members_list if m['profession'] == '騎士')
-        swordsman_count = sum(1 for m in members_list if m['profession'] == '剣士')
+        sage_count = sum(1 for m in members_list if m.profession == '賢者')
+        knight_count = sum(1 for m in members_list if m.profession == '騎士')
+        swordsman_count = sum(1 for m in members_list if m.profession == '剣士')
         
         if sage_count > max_sages:
-            role_warnings += f'⚠️ **注意:** このチームには賢者が{sage_count}名います。（上限は{max_sages}名です）\n'
+            lines.append(f'⚠️ **注意:** このチームには賢者が{sage_count}名います。（上限は{max_sages}名です）')
         if knight_count > max_knights:
-            role_warnings += f'⚠️ **注意:** このチームには騎士が{knight_count}名います。（上限は{max_knights}名です）\n'
+            lines.append(f'⚠️ **注意:** このチームには騎士が{knight_count}名います。（上限は{max_knights}名です）')
         if swordsman_count > max_swordsmen:
-            role_warnings += f'⚠️ **注意:** このチームには剣士が{swordsman_count}名います。（上限は{max_swordsmen}名です）\n'
+            lines.append(f'⚠️ **注意:** このチームには剣士が{swordsman_count}名います。（上限は{max_swordsmen}名です）')
 
-        message += f'**=== チーム {i + 1} ===**\n'
-        if leader:
-            message += f'リーダー: **{leader["name"]}** ({leader["profession"]})\n'
-        else:
-            message += f'リーダー: **未決定**\n'
-            message += '⚠️ **注意:** リーダー候補がいなかったためリーダーが自動設定されませんでした。\n'
-        message += team_size_warning
-        message += warning_message
-        message += role_warnings
-        message += f'メンバー: {members_str}\n'
-        message += f'合計戦力: **{team_power_total}**\n\n'
+        lines.append(f'メンバー: {members_str}')
+        lines.append(f'合計戦力: **{team_power_total}**')
+        lines.append('')
     
     if leftover:
-        leftover_str = ', '.join([f'{m["name"]} ({m["profession"]})' for m in leftover])
-        message += f'\n**⚠️ 余剰メンバー**\n{leftover_str}\n'
+        leftover_str = ', '.join([f'{members_by_id[member_id].name} ({members_by_id[member_id].profession})' for member_id in leftover])
+        lines.append('')
+        lines.append('**⚠️ 余剰メンバー**')
+        lines.append(leftover_str)
 
-    await interaction.followup.send(message)
-    print("--- Debug Log: Command finished successfully ---")
+    return '\n'.join(lines) + '\n'
 
-def create_groups(members, group_type, max_sages, max_knights, max_swordsmen):
+@bot.tree.command(name='regroup', description='直前の編成結果を、参加・離脱したメンバーに合わせて最小限の入れ替えで修正します。')
+@app_commands.describe(
+    joined='途中から参加するメンバーの名前 (スペース区切り)',
+    left='離脱するメンバーの名前 (スペース区切り)'
+)
+@instrumented
+async def regroup(interaction: discord.Interaction, joined: str = None, left: str = None):
     """
-    メンバーを可能な限り4人組に分配し、賢者、騎士、剣士の数を考慮してバランスの取れたチームを作成します。
-    余剰メンバーがいる場合はそのリストを返します。
+    Repairs the channel's last grouping with repair_groups instead of forming every team again:
+    only the teams affected by the joins and leaves change. The repair runs in a worker thread.
     """
-    if group_type == 'high_power':
-        members.sort(key=lambda x: x['power'], reverse=True)
-    else:
-        random.shuffle(members)
+    await interaction.response.defer()
+    mark_deferred()
+    shard = await get_shard(interaction)
+    grouping = await shard.last_grouping(interaction.channel_id)
+    if grouping is None:
+        await interaction.followup.send('このチャンネルにはまだ編成結果がありません。`/auto_create_group` でグループを編成してください。')
+        return
 
-    num_total_members = len(members)
-    
-    if num_total_members < 3:
-        return [], members
+    grouped_ids = {
+        member_id for team in grouping['teams']
+        for member_id in team['members'] + ([team['leader']] if team['leader'] is not None else [])
+    }
+    # Members removed from the roster since the grouping was made leave as well
+    left_ids = {member_id for member_id in grouped_ids if shard.roster.by_id(member_id) is None}
+    removed_count = len(left_ids)
+
+    joined_members = []
+    not_found = []
+    already_grouped = []
+    for name in (joined or '').split():
+        member = shard.roster.get(name)
+        if member is None:
+            not_found.append(name)
+        elif member.id in grouped_ids or member in joined_members:
+            already_grouped.append(name)
+        else:
+            joined_members.append(member)
+
+    not_grouped = []
+    for name in (left or '').split():
+        member = shard.roster.get(name)
+        if member is None:
+            not_found.append(name)
+        elif member.id not in grouped_ids:
+            not_grouped.append(name)
+        else:
+            left_ids.add(member.id)
 
-    teams = []
-    leftover = []
-    
-    # 4人組チームを可能な限り作成
-    num_four_person_teams = num_total_members // 4
-    
-    for i in range(num_four_person_teams):
-        teams.append(members[i*4:(i+1)*4])
-        
-    # 余剰メンバーを抽出
-    leftover = members[num_four_person_teams*4:]
-    
-    # 余剰メンバーが3人以上いる場合、そのメンバーたちだけでチームを作成
-    if len(leftover) >= 3:
-        teams.append(leftover)
-        leftover = []
-    else:
-        # 余剰メンバーを既存のチームに分配
-        for member in leftover:
-            # 戦力が最も低いチームに追加
-            teams.sort(key=lambda team: sum(m['power'] for m in team))
-            teams[0].append(member)
-        leftover = []
-
-    # 職業バランスを調整するための追加処理
-    for _ in range(5):  # 5回繰り返してバランスを最適化
-        swapped = False
-        for i in range(len(teams)):
-            for j in range(i + 1, len(teams)):
-                team_a = teams[i]
-                team_b = teams[j]
-                
-                # 賢者、騎士、剣士の数が上限を超えていないかチェック
-                if sum(1 for m in team_a if m['profession'] == '賢者') > max_sages and sum(1 for m in team_b if m['profession'] == '賢者') < max_sages:
-                    sage_a = next((m for m in team_a if m['profession'] == '賢者'), None)
-                    non_sage_b = next((m for m in team_b if m['profession'] != '賢者'), None)
-                    if sage_a and non_sage_b:
-                        team_a.remove(sage_a)
-                        team_b.remove(non_sage_b)
-                        team_a.append(non_sage_b)
-                        team_b.append(sage_a)
-                        swapped = True
-                        
-                if sum(1 for m in team_a if m['profession'] == '騎士') > max_knights and sum(1 for m in team_b if m['profession'] == '騎士') < max_knights:
-                    knight_a = next((m for m in team_a if m['profession'] == '騎士'), None)
-                    non_knight_b = next((m for m in team_b if m['profession'] != '騎士'), None)
-                    if knight_a and non_knight_b:
-                        team_a.remove(knight_a)
-                        team_b.remove(non_knight_b)
-                        team_a.append(non_knight_b)
-                        team_b.append(knight_a)
-                        swapped = True
-
-                if sum(1 for m in team_a if m['profession'] == '剣士') > max_swordsmen and sum(1 for m in team_b if m['profession'] == '剣士') < max_swordsmen:
-                    swordsman_a = next((m for m in team_a if m['profession'] == '剣士'), None)
-                    non_swordsman_b = next((m for m in team_b if m['profession'] != '剣士'), None)
-                    if swordsman_a and non_swordsman_b:
-                        team_a.remove(swordsman_a)
-                        team_b.remove(non_swordsman_b)
-                        team_a.append(non_swordsman_b)
-                        team_b.append(swordsman_a)
-                        swapped = True
-        if not swapped:
-            break
-            
-    return teams, leftover
+    message = ''
+    if not_found:
+        message += f'⚠️ 登録されていないメンバー: `{", ".join(not_found)}`\n'
+    if already_grouped:
+        message += f'⚠️ すでにチームにいるメンバー: `{", ".join(already_grouped)}`\n'
+    if not_grouped:
+        message += f'⚠️ チームにいないメンバー: `{", ".join(not_grouped)}`\n'
+    if not joined_members and not left_ids:
+        await interaction.followup.send(message or '参加・離脱するメンバーを指定してください。')
+        return
 
+    # Only the grouped members and the newcomers are resolved, on the event loop; the worker thread never reads the roster
+    members_by_id = {member_id: member for member_id in grouped_ids if (member := shard.roster.by_id(member_id)) is not None}
+    members_by_id.update((member.id, member) for member in joined_members)
+    try:
+        with stage('regroup'):
+            result = await asyncio.to_thread(
+                repair_groups, grouping['teams'], members_by_id, joined_members, left_ids, list(shard.leader_candidates),
+                grouping['max_sages'], grouping['max_knights'], grouping['max_swordsmen'],
+                group_type=grouping['group_type'], pinned=grouping.get('pinned', ())
+            )
+    except GroupingError as e:
+        await interaction.followup.send(message + str(e))
+        return
+    shard.save_grouping(interaction.channel_id, dict(grouping, teams=result['teams'], leftover=result['leftover'], pinned=result['pinned']))
+
+    with stage('render'):
+        message = '**🔧 再編成結果**\n\n' + message
+        if removed_count:
+            message += f'戦力リストから削除された{removed_count}人をチームから外しました。\n'
+        moved = [
+            f'`{members_by_id[member_id].name}` → ' + (f'チーム {team + 1}' if team is not None else '離脱')
+            for member_id, team in result['moves'] if member_id in members_by_id
+        ]
+        if moved:
+            message += '変更: ' + ', '.join(moved) + '\n'
+        message += f'変更されたチーム: {len(result["changed"])} / {len(result["teams"])} (変更されたチームの{format_score(result["score"])})\n\n'
+        message += render_groups(result, members_by_id, grouping['max_sages'], grouping['max_knights'], grouping['max_swordsmen'])
+
+    with stage('discord_api'):
+        await send_text(interaction.followup.send, message)
 
 @bot.tree.command(name='add_leader_candidate', description='リーダー候補にメンバーを追加します。')
 @app_commands.describe(member_names='追加するメンバーの名前 (スペース区切り)')
+@instrumented
 async def add_leader_candidate(interaction: discord.Interaction, member_names: str):
     """
     Adds one or more members to the list of leader candidates.
     """
+    shard = await get_shard(interaction)
     added_members = []
     not_found_members = []
     
     names_list = member_names.split()
 
     for member_name in names_list:
-        if member_name not in [p['name'] for p in OVERALL_RANKS]:
+        if member_name not in shard.roster:
             not_found_members.append(member_name)
-        elif member_name in LEADER_CANDIDATES:
+        elif member_name in shard.leader_candidates:
             pass
         else:
-            LEADER_CANDIDATES.append(member_name)
+            shard.leader_candidates.append(member_name)
             added_members.append(member_name)
     
     message = ''
@@ -759,23 +1222,26 @@ async def add_leader_candidate(interaction: discord.Interaction, member_names: s
 
     if not message:
         message = '指定されたメンバーはすべてすでにリーダー候補です。'
-    
+
+    shard.save_leader_candidates()
     await interaction.response.send_message(message)
 
 @bot.tree.command(name='remove_leader_candidate', description='リーダー候補からメンバーを削除します。')
 @app_commands.describe(member_names='削除するメンバーの名前 (スペース区切り)')
+@instrumented
 async def remove_leader_candidate(interaction: discord.Interaction, member_names: str):
     """
     Removes one or more members from the list of leader candidates.
     """
+    shard = await get_shard(interaction)
     removed_members = []
     not_found_candidates = []
     
     names_list = member_names.split()
 
     for member_name in names_list:
-        if member_name in LEADER_CANDIDATES:
-            LEADER_CANDIDATES.remove(member_name)
+        if member_name in shard.leader_candidates:
+            shard.leader_candidates.remove(member_name)
             removed_members.append(member_name)
         else:
             not_found_candidates.append(member_name)
@@ -790,21 +1256,201 @@ async def remove_leader_candidate(interaction: discord.Interaction, member_names
     if not message:
         message = '指定されたメンバーはすべてリーダー候補リストに見つかりませんでした。'
 
+    shard.save_leader_candidates()
     await interaction.response.send_message(message)
         
 @bot.tree.command(name='power_list', description='各職業の戦力ランキングを表示します。')
+@instrumented
 async def power_list(interaction: discord.Interaction):
     """
     Displays the overall power ranking and rankings by profession.
     """
-    message = '**🏆 全体戦力ランキング**\n'
-    sorted_overall_ranks = sorted(OVERALL_RANKS, key=lambda x: x['power'], reverse=True)
-    for i, member in enumerate(sorted_overall_ranks):
-        message += f'{i + 1}. {member["name"]}さん ({member["profession"]}): 戦力 {member["power"]}\n'
+    shard = await get_shard(interaction)
+    # (profession or None for the overall ranking, first rank) of every page
+    pages = [(None, start) for start in range(0, max(1, len(shard.roster)), MEMBERS_PER_PAGE)]
+    for profession in PROFESSIONS:
+        pages.extend((profession, start) for start in range(0, max(1, shard.roster.count(profession)), MEMBERS_PER_PAGE))
+
+    def render_page(page):
+        profession, start = pages[page]
+        stop = start + MEMBERS_PER_PAGE
+        if profession is None:
+            lines = ['**🏆 全体戦力ランキング**']
+            for i, member in enumerate(shard.roster.by_power(start, stop), start=start):
+                lines.append(f'{i + 1}. {member.name[:MAX_DISPLAY_NAME]}さん ({member.profession}): 戦力 {member.power}')
+        else:
+            lines = ['---**職業別ランキング**---', f'**{profession}**']
+            for i, member in enumerate(shard.roster.by_profession(profession, start, stop), start=start):
+                lines.append(f'{i + 1}. {member.name[:MAX_DISPLAY_NAME]}さん: 戦力 {member.power}')
+        return '\n'.join(lines)
 
-    message += '\n---**職業別ランキング**---\n\n'
-    
-    rebuild_player_ranks()
+    await send_paginated(interaction.response.send_message, render_page, len(pages))
+
+@bot.tree.command(name='power_history', description='メンバーの戦力値の変更履歴を表示します。')
+@app_commands.describe(member_name='履歴を表示するメンバーの名前')
+@app_commands.autocomplete(member_name=all_member_autocomplete)
+@instrumented
+async def power_history(interaction: discord.Interaction, member_name: str):
+    """
+    Displays a member's latest power changes, newest first, with the change from the previous value.
+    """
+    shard = await get_shard(interaction)
+    member = shard.roster.get(member_name)
+    if member is None:
+        await interaction.response.send_message(f'`{member_name}`さんはリストに登録されていません。')
+        return
+    await interaction.response.defer()
+    mark_deferred()
+    await asyncio.to_thread(STORAGE.flush)
+    # One extra entry, for the change of the oldest entry shown
+    rows = await asyncio.to_thread(STORAGE.load_member_power_history, shard.guild_id, member.id, POWER_HISTORY_ENTRIES + 1)
+    if not rows:
+        await interaction.followup.send(f'`{member_name}`さんの戦力の履歴はありません。')
+        return
+
+    lines = [f'**📈 {member_name[:MAX_DISPLAY_NAME]}さんの戦力の履歴** (現在: {member.power})']
+    for (ts, power), previous in zip(rows[:POWER_HISTORY_ENTRIES], rows[1:] + [(None, None)]):
+        if power is None:
+            lines.append(f'{format_time(ts)}: 削除')
+        elif previous[1] is None:
+            lines.append(f'{format_time(ts)}: {power}')
+        else:
+            lines.append(f'{format_time(ts)}: {power} ({power - previous[1]:+d})')
+    await send_text(interaction.followup.send, '\n'.join(lines))
+
+@bot.tree.command(name='rank_as_of', description='指定した日の終わり時点の戦力ランキングを表示します。')
+@app_commands.describe(
+    date='日付 (YYYY-MM-DD, 日本時間)',
+    member_name='指定するとそのメンバーの順位を表示します (省略可)',
+    profession='職業別ランキングにする場合の職業 (剣士, 騎士, 魔導士, 賢者)'
+)
+@app_commands.autocomplete(member_name=all_member_autocomplete)
+@instrumented
+async def rank_as_of(interaction: discord.Interaction, date: str, member_name: str = None, profession: str = None):
+    """
+    Displays the ranking (or one member's rank) at the end of a past day, rebuilt from the power history.
+    """
+    shard = await get_shard(interaction)
+    try:
+        ts = parse_date(date)
+    except ValueError:
+        await interaction.response.send_message('日付は `YYYY-MM-DD` の形式で指定してください。')
+        return
+    if profession is not None and profession not in PROFESSIONS:
+        await interaction.response.send_message(f'無効な職業です。利用可能な職業: {", ".join(PROFESSIONS.keys())}')
+        return
+    member = None
+    if member_name is not None:
+        member = shard.roster.get(member_name)
+        if member is None:
+            await interaction.response.send_message(f'`{member_name}`さんはリストに登録されていません。')
+            return
 
-    for profession, ranks in PLAYER_RANKS.items():
-        message += f'**{profession}**\n'
+    await interaction.response.defer()
+    mark_deferred()
+    state = await load_power_state(shard, ts)
+    if not state:
+        await interaction.followup.send(f'{date} 時点の戦力の履歴はありません。')
+        return
+
+    if member is not None:
+        rank = state.rank_of(member.id)
+        if rank is None:
+            await interaction.followup.send(f'{date} 時点では`{member_name}`さんは登録されていませんでした。')
+            return
+        power, member_profession, overall, count, profession_rank, profession_count = rank
+        await interaction.followup.send(
+            f'**{member_name}**さんの{date}時点の戦力: **{power}** ({member_profession})\n'
+            f'全体: {overall}位 / {count}人, {member_profession}: {profession_rank}位 / {profession_count}人'
+        )
+        return
+
+    ranking = state.ranking(profession)
+    title = f'**🏆 {date} 時点の' + (f'{profession}ランキング**' if profession else '全体戦力ランキング**')
+
+    def render_page(page):
+        start = page * MEMBERS_PER_PAGE
+        lines = [title]
+        for i, index in enumerate(ranking[start:start + MEMBERS_PER_PAGE], start=start):
+            lines.append(f'{i + 1}. {member_label(shard, int(state.ids[index]))} ({state.professions[index]}): 戦力 {state.powers[index]}')
+        return '\n'.join(lines)
+
+    await send_paginated(interaction.followup.send, render_page, max(1, -(-len(ranking) // MEMBERS_PER_PAGE)))
+
+@bot.tree.command(name='top_gainers', description='指定期間に戦力が最も伸びたメンバーを表示します。')
+@app_commands.describe(
+    days='期間の日数 (デフォルトは30日)',
+    profession='職業で絞り込む場合の職業 (剣士, 騎士, 魔導士, 賢者)',
+    count='表示する人数 (デフォルトは10人)'
+)
+@instrumented
+async def top_gainers(interaction: discord.Interaction, days: int = 30, profession: str = None, count: int = 10):
+    """
+    Displays the members whose power rose the most over the last `days` days (current roster against the history).
+    """
+    shard = await get_shard(interaction)
+    if profession is not None and profession not in PROFESSIONS:
+        await interaction.response.send_message(f'無効な職業です。利用可能な職業: {", ".join(PROFESSIONS.keys())}')
+        return
+    days = max(1, min(days, MAX_GAIN_DAYS))
+    count = max(1, min(count, MAX_TOP_GAINERS))
+
+    await interaction.response.defer()
+    mark_deferred()
+    then = await load_power_state(shard, time.time() - days * 86400)
+    if not then:
+        await interaction.followup.send(f'{days}日前の戦力の履歴はありません。')
+        return
+    gainers = find_top_gainers(then, PowerState.from_roster(shard.roster), count, profession)
+
+    lines = [f'**🚀 過去{days}日間で戦力が伸びたメンバー' + (f' ({profession})' if profession else '') + '**']
+    for i, (member_id, before, after) in enumerate(gainers, start=1):
+        lines.append(f'{i}. {member_label(shard, member_id)}さん: {before} → {after} ({after - before:+d})')
+    if not gainers:
+        lines.append('該当するメンバーがいません。')
+    await send_text(interaction.followup.send, '\n'.join(lines))
+
+@bot.tree.command(name='power_percentiles', description='職業ごとの戦力のパーセンタイルを表示します。')
+@app_commands.describe(date='日付 (YYYY-MM-DD, 日本時間)。省略すると現在の値を表示します')
+@instrumented
+async def power_percentiles(interaction: discord.Interaction, date: str = None):
+    """
+    Displays the PERCENTILES of each profession's powers, now (from the roster's sorted
+    indexes) or at the end of a past day (from the power history).
+    """
+    shard = await get_shard(interaction)
+    if date is None:
+        percentiles = {profession: roster_percentiles(shard.roster, profession) for profession in PROFESSIONS}
+        title = '**📊 職業別の戦力パーセンタイル (現在)**'
+        await interaction.response.defer()
+        mark_deferred()
+    else:
+        try:
+            ts = parse_date(date)
+        except ValueError:
+            await interaction.response.send_message('日付は `YYYY-MM-DD` の形式で指定してください。')
+            return
+        await interaction.response.defer()
+        mark_deferred()
+        state = await load_power_state(shard, ts)
+        if not state:
+            await interaction.followup.send(f'{date} 時点の戦力の履歴はありません。')
+            return
+        percentiles = {profession: state.percentiles(profession) for profession in PROFESSIONS}
+        title = f'**📊 職業別の戦力パーセンタイル ({date} 時点)**'
+
+    lines = [title, '職業: ' + ' / '.join(f'{point}%' for point in PERCENTILES)]
+    for profession, values in percentiles.items():
+        lines.append(f'{profession}: ' + (' / '.join(map(str, values)) if values else 'メンバーなし'))
+    await interaction.followup.send('\n'.join(lines))
+
+if __name__ == '__main__':
+    try:
+        bot.run(TOKEN, log_handler=None)
+    finally:
+        if grouping_pool is not None:
+            grouping_pool.shutdown(cancel_futures=True)
+        STORAGE.close()
+        WATCHDOG.stop()
+        HEALTH.close()
+        LOG_LISTENER.stop()
@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+
+class GroupingCache:
+    """
+    Bounded LRU cache of rendered auto_create_group results.
+    Entries are remembered per user so that they can be dropped as soon as that user's
+    selection state changes; roster or leader changes clear the whole cache.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (user_id, messages)
+        self._user_keys = {}           # user_id -> set of keys
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, user_id, key, messages):
+        self._entries[key] = (user_id, messages)
+        self._entries.move_to_end(key)
+        self._user_keys.setdefault(user_id, set()).add(key)
+        while len(self._entries) > self.maxsize:
+            old_key, (old_user_id, _) = self._entries.popitem(last=False)
+            self._user_keys[old_user_id].discard(old_key)
+
+    def evict_user(self, user_id):
+        """Drops the entries computed for `user_id`."""
+        for key in self._user_keys.pop(user_id, ()):
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._user_keys.clear()
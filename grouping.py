@@ -0,0 +1,750 @@
+import math
+import random
+import time
+from bisect import bisect_left
+
+import numpy as np
+
+# Define professions and their roles
+PROFESSIONS = {
+    '剣士': '前衛',
+    '騎士': '前衛',
+    '魔導士': '後衛',
+    '賢者': '後衛'
+}
+
+HEALER_PROFESSION = '賢者'
+
+# Integer codes used by the vectorized scoring
+PROFESSION_CODES = {profession: code for code, profession in enumerate(PROFESSIONS)}
+ROLE_CODES = {'前衛': 0, '後衛': 1}
+FRONT_LINE_CODES = [PROFESSION_CODES[p] for p, role in PROFESSIONS.items() if role == '前衛']
+
+# Number of random orders scored at once to pick the optimizer's starting point
+NUM_STARTS = 256
+
+# Default time budget (seconds) for the team optimizer
+DEFAULT_TIME_BUDGET = 0.3
+# Swaps per second of time budget used instead of the wall clock when a seed is given,
+# so that seeded runs are reproducible on any machine and under any load. The time budget
+# still bounds seeded runs; a run cut short by it is marked 'time_limited' (not reproducible).
+# Set below the measured swap rate (60k-80k per second) so that seeded runs normally finish in time.
+ITERATIONS_PER_SECOND = 50000
+
+# Weights of the optimizer's objective. Role caps dominate, then the front-line/healer
+# requirements, then the power spread (normalized so that it is independent of the power scale).
+CAP_PENALTY = 100.0
+MISSING_ROLE_PENALTY = 20.0
+POWER_WEIGHT = 10.0
+LEADERLESS_PENALTY = 10.0
+
+# repair_groups: swap partners checked per profession on each side of the wanted power, and the
+# power objective gain a swap must exceed when it fixes no role problem (a team 20% off its target costs 0.4)
+REPAIR_NEIGHBOURS = 3
+REPAIR_MIN_POWER_GAIN = 0.4
+
+
+class GroupingError(Exception):
+    """Raised when no grouping can be formed. The message is shown to the user as is."""
+
+
+def form_groups(roster_members, leader_candidates, excluded_list, carried_list, fixed_list, fixed_probability,
+                preferred_list, preferred_probability, group_type, max_sages, max_knights, max_swordsmen,
+                time_budget=DEFAULT_TIME_BUDGET, seed=None):
+    """
+    Runs the whole team formation for auto_create_group over `roster_members` (roster.Member objects) and returns
+    `{'teams': [{'leader': id or None, 'members': [id, ...]}, ...], 'leftover': [id, ...], 'score': {...}, 'seed': seed,
+    'time_limited': bool, 'pinned': [team index, ...]}` where the ids are Member.id values and 'pinned' are the teams that
+    were not formed by the optimizer (the fixed/preferred team and the carry team). Only plain data goes in and out, so this can run in a
+    worker process. With the same `seed` and inputs the result is always the same, unless the optimizer was stopped
+    by `time_budget` before its swap count ('time_limited').
+    """
+    deadline = time.perf_counter() + time_budget
+    rng = random.Random(seed)
+    max_iterations = None if seed is None else int(time_budget * ITERATIONS_PER_SECOND)
+    leader_set = set(leader_candidates)
+    members_by_name = {m.name: m for m in roster_members}
+
+    team1_members = []
+    other_members = []
+
+    for member_name in fixed_list:
+        member = members_by_name.get(member_name)
+        if member and rng.random() < fixed_probability:
+            team1_members.append(member)
+        elif member:
+            other_members.append(member)
+
+    for member_name in preferred_list:
+        member = members_by_name.get(member_name)
+        if member and rng.random() < preferred_probability:
+            team1_members.append(member)
+        elif member:
+            other_members.append(member)
+
+    processed_names = set(m.name for m in team1_members) | set(m.name for m in other_members) | set(excluded_list)
+    available_members = [p for p in roster_members if p.name not in processed_names]
+    available_members.extend(other_members)
+    rng.shuffle(available_members)
+
+    num_total_members = len(team1_members) + len(available_members)
+
+    if num_total_members < 3 and len(team1_members) < 3:
+        raise GroupingError(
+            f'⚠️ グループを作成するには最低3人のメンバーが必要です。現在参加可能なメンバーは**{num_total_members}人**です。\n'
+            f'`/member_list`コマンドでメンバーを確認してください。'
+        )
+
+    final_teams = []
+    leftover = []
+    pinned = []
+
+    if team1_members:
+        pinned.append(len(final_teams))
+        final_teams.append(team1_members)
+
+    if group_type == 'carry':
+        if not carried_list or not any(m.name == carried_list[0] for m in available_members):
+            raise GroupingError(f'指定されたキャリーメンバー `{carried_list[0] if carried_list else ""}` が参加可能メンバーリストに見つかりませんでした。')
+
+        carried_member = next(m for m in available_members if m.name == carried_list[0])
+        remaining_members = [m for m in available_members if m.name != carried_list[0]]
+        remaining_members.sort(key=lambda x: x.power, reverse=True)
+
+        if len(remaining_members) < 3:
+            raise GroupingError(f'キャリーチームを編成するには、{len(remaining_members)}人ではメンバーが不足しています。')
+
+        top_players_pool = remaining_members[:10]
+        if len(top_players_pool) < 3:
+            top_3_members = top_players_pool
+        else:
+            top_3_members = rng.sample(top_players_pool, 3)
+
+        top_3_ids = {m.id for m in top_3_members}
+        remaining_members_for_balance = [m for m in remaining_members if m.id not in top_3_ids]
+
+        pinned.append(len(final_teams))
+        final_teams.append([carried_member] + top_3_members)
+
+        teams_balance, leftover = create_groups(remaining_members_for_balance, 'balance', max_sages, max_knights, max_swordsmen, time_budget, rng, leader_set, max_iterations, deadline)
+        final_teams.extend(teams_balance)
+
+    else:
+        teams, leftover = create_groups(available_members, group_type, max_sages, max_knights, max_swordsmen, time_budget, rng, leader_set, max_iterations, deadline)
+        final_teams.extend(teams)
+    time_limited = max_iterations is not None and time.perf_counter() >= deadline
+
+    teams_with_leader = []
+    for team in final_teams:
+        leader = None
+        leader_candidates_in_team = [m for m in team if m.name in leader_set]
+        if leader_candidates_in_team:
+            leader = max(leader_candidates_in_team, key=lambda x: x.power)
+
+        team_members_without_leader = [m for m in team if m is not leader]
+
+        teams_with_leader.append({
+            'members': team_members_without_leader,
+            'leader': leader
+        })
+
+    caps = {'賢者': max_sages, '騎士': max_knights, '剣士': max_swordsmen}
+    return {
+        'teams': [
+            {'leader': team['leader'].id if team['leader'] else None, 'members': [m.id for m in team['members']]}
+            for team in teams_with_leader
+        ],
+        'leftover': [m.id for m in leftover],
+        'score': score_grouping(teams_with_leader, caps),
+        'seed': seed,
+        'time_limited': time_limited,
+        'pinned': pinned
+    }
+
+
+def score_grouping(teams_with_leader, caps):
+    """
+    Scores teams given as `[{'leader': Member or None, 'members': [Member, ...]}, ...]` (lower is better) on role-cap excess, teams without a healer
+    or a front liner, leaderless teams and the spread of total team power.
+    Returns a dict with the total under 'total' and each component.
+    """
+    members = []
+    assignment = []
+    leader_names = set()
+    for team_index, team_data in enumerate(teams_with_leader):
+        team = team_data['members'] + ([team_data['leader']] if team_data['leader'] else [])
+        members.extend(team)
+        assignment.extend([team_index] * len(team))
+        if team_data['leader']:
+            leader_names.add(team_data['leader'].name)
+
+    scores = score_assignments(MemberArrays(members, leader_names), np.array([assignment], dtype=np.int64), len(teams_with_leader), caps)
+    return {
+        'total': float(scores['total'][0]),
+        'violations': int(scores['violations'][0]),
+        'missing_roles': int(scores['missing_roles'][0]),
+        'leaderless': int(scores['leaderless'][0]),
+        'power_stdev': float(scores['power_stdev'][0])
+    }
+
+
+class MemberArrays:
+    """Members encoded as arrays: power, profession code, role code and leader flag."""
+
+    __slots__ = ('members', 'power', 'profession', 'role', 'leader')
+
+    def __init__(self, members, leader_names=()):
+        leader_names = set(leader_names)
+        self.members = list(members)
+        count = len(self.members)
+        self.power = np.fromiter((m.power for m in self.members), dtype=np.int64, count=count)
+        self.profession = np.fromiter((PROFESSION_CODES[m.profession] for m in self.members), dtype=np.int64, count=count)
+        self.role = np.fromiter((ROLE_CODES[PROFESSIONS[m.profession]] for m in self.members), dtype=np.int8, count=count)
+        self.leader = np.fromiter((m.name in leader_names for m in self.members), dtype=bool, count=count)
+
+
+def score_assignments(arrays, assignments, num_teams, caps):
+    """
+    Scores many assignments at once. `assignments` is a (k, n) integer array holding the team
+    index of each member of `arrays` (-1 for members outside every team).
+    Returns a dict of (k,) arrays with the same keys as score_grouping.
+    """
+    assignments = np.atleast_2d(assignments)
+    k, n = assignments.shape
+    num_professions = len(PROFESSION_CODES)
+
+    assigned = assignments >= 0
+    rows = np.broadcast_to(np.arange(k)[:, None], (k, n))[assigned]
+    columns = np.broadcast_to(np.arange(n)[None, :], (k, n))[assigned]
+    slots = rows * num_teams + assignments[assigned]
+    num_slots = k * num_teams
+
+    size = np.bincount(slots, minlength=num_slots).reshape(k, num_teams)
+    power = np.bincount(slots, weights=arrays.power[columns], minlength=num_slots).reshape(k, num_teams)
+    leaders = np.bincount(slots, weights=arrays.leader[columns], minlength=num_slots).reshape(k, num_teams)
+    profession_counts = np.bincount(
+        slots * num_professions + arrays.profession[columns], minlength=num_slots * num_professions
+    ).reshape(k, num_teams, num_professions)
+
+    cap_array = np.full(num_professions, np.iinfo(np.int64).max, dtype=np.int64)
+    for profession, cap in caps.items():
+        cap_array[PROFESSION_CODES[profession]] = cap
+    violations = np.maximum(profession_counts - cap_array, 0).sum(axis=(1, 2))
+
+    active = size > 0
+    front_liners = profession_counts[:, :, FRONT_LINE_CODES].sum(axis=2)
+    healers = profession_counts[:, :, PROFESSION_CODES[HEALER_PROFESSION]]
+    missing_roles = ((front_liners == 0) & active).sum(axis=1) + ((healers == 0) & active).sum(axis=1)
+    leaderless = ((leaders == 0) & active).sum(axis=1)
+
+    num_active = np.maximum(active.sum(axis=1), 1)
+    mean = power.sum(axis=1) / num_active
+    variance = (((power - mean[:, None]) ** 2) * active).sum(axis=1) / num_active
+    power_term = POWER_WEIGHT * num_active * variance / np.maximum(mean, 1.0) ** 2
+
+    total = CAP_PENALTY * violations + MISSING_ROLE_PENALTY * missing_roles + LEADERLESS_PENALTY * leaderless + power_term
+    return {
+        'total': total,
+        'violations': violations,
+        'missing_roles': missing_roles,
+        'leaderless': leaderless,
+        'power_stdev': np.sqrt(variance)
+    }
+
+
+def _best_order(members, caps, leader_names, rng, starts=NUM_STARTS):
+    """
+    Scores `starts` random orders of `members` at once (chunked into teams of four the way
+    create_groups does) and returns the best one.
+    """
+    count = len(members)
+    num_four_person_teams = count // 4
+    layout = np.arange(count) // 4
+    extra = count - num_four_person_teams * 4
+    if extra >= 3:
+        num_teams = num_four_person_teams + 1
+    else:
+        layout[num_four_person_teams * 4:] = np.arange(extra)
+        num_teams = num_four_person_teams
+
+    np_rng = np.random.default_rng(rng.getrandbits(64))
+    orders = np_rng.permuted(np.tile(np.arange(count), (starts, 1)), axis=1)
+    assignments = np.empty_like(orders)
+    np.put_along_axis(assignments, orders, np.broadcast_to(layout, orders.shape), axis=1)
+
+    scores = score_assignments(MemberArrays(members, leader_names), assignments, num_teams, caps)
+    best = orders[int(np.argmin(scores['total']))]
+    return [members[i] for i in best]
+
+
+def create_groups(members, group_type, max_sages, max_knights, max_swordsmen, time_budget=DEFAULT_TIME_BUDGET, rng=random, leader_names=(), max_iterations=None, deadline=None):
+    """
+    メンバーを可能な限り4人組に分配し、賢者、騎士、剣士の数を考慮してバランスの取れたチームを作成します。
+    余剰メンバーがいる場合はそのリストを返します。
+    """
+    caps = {'賢者': max_sages, '騎士': max_knights, '剣士': max_swordsmen}
+    leader_names = set(leader_names)
+
+    if group_type == 'high_power':
+        members.sort(key=lambda x: x.power, reverse=True)
+    elif time_budget > 0 and len(members) >= 8:
+        # 多数のランダムな並び順を一括で評価し、最も良いものを最適化の初期値にする
+        members[:] = _best_order(members, caps, leader_names, rng)
+    else:
+        rng.shuffle(members)
+
+    num_total_members = len(members)
+
+    if num_total_members < 3:
+        return [], members
+
+    teams = []
+    leftover = []
+
+    # 4人組チームを可能な限り作成
+    num_four_person_teams = num_total_members // 4
+
+    for i in range(num_four_person_teams):
+        teams.append(members[i*4:(i+1)*4])
+
+    # 余剰メンバーを抽出
+    leftover = members[num_four_person_teams*4:]
+
+    # 余剰メンバーが3人以上いる場合、そのメンバーたちだけでチームを作成
+    if len(leftover) >= 3:
+        teams.append(leftover)
+        leftover = []
+    else:
+        # 余剰メンバーを既存のチームに分配
+        for member in leftover:
+            # 戦力が最も低いチームに追加
+            teams.sort(key=lambda team: sum(m.power for m in team))
+            teams[0].append(member)
+        leftover = []
+
+    # 職業の上限と戦力バランスを最適化
+    optimize_teams(teams, caps, balance_power=group_type != 'high_power', time_budget=time_budget, rng=rng, leader_names=leader_names, max_iterations=max_iterations, deadline=deadline)
+
+    return teams, leftover
+
+
+class _TeamStats:
+    """Per-team profession counts, leader count and power total, updated incrementally on every swap."""
+
+    __slots__ = ('counts', 'leaders', 'power')
+
+    def __init__(self, team, leader_names):
+        self.counts = {}
+        self.leaders = 0
+        self.power = 0
+        for member in team:
+            self.counts[member.profession] = self.counts.get(member.profession, 0) + 1
+            self.leaders += member.name in leader_names
+            self.power += member.power
+
+
+def _role_penalty(counts, leaders, caps):
+    penalty = 0.0 if leaders else LEADERLESS_PENALTY
+    for profession, cap in caps.items():
+        excess = counts.get(profession, 0) - cap
+        if excess > 0:
+            penalty += CAP_PENALTY * excess
+    if not any(counts.get(p, 0) for p, role in PROFESSIONS.items() if role == '前衛'):
+        penalty += MISSING_ROLE_PENALTY
+    if not counts.get(HEALER_PROFESSION, 0):
+        penalty += MISSING_ROLE_PENALTY
+    return penalty
+
+
+def _swapped_counts(counts, removed, added):
+    if removed == added:
+        return counts
+    counts = dict(counts)
+    counts[removed] -= 1
+    counts[added] = counts.get(added, 0) + 1
+    return counts
+
+
+def optimize_teams(teams, caps, balance_power=True, time_budget=DEFAULT_TIME_BUDGET, rng=random, leader_names=(), max_iterations=None, deadline=None):
+    """
+    Improves `teams` in place by simulated annealing over member swaps between teams.
+
+    The objective is the role-cap excess, missing front liners/healers/leaders and the squared
+    distance of each team's total power from its target: the average team power when
+    `balance_power` is set, otherwise the team's starting power (so that the tiers of a
+    high_power grouping are kept and only role problems are repaired).
+    Team sizes never change. Returns the objective value of the best assignment found
+    within `time_budget` seconds (or until `deadline`, a time.perf_counter() value), or within
+    `max_iterations` swaps when that is given (the annealing schedule then only depends on `rng`,
+    but the time limit still applies, and a run it stops is no longer reproducible).
+    """
+    if len(teams) < 2:
+        return 0.0
+
+    stats = [_TeamStats(team, leader_names) for team in teams]
+    total_power = sum(s.power for s in stats)
+    if balance_power:
+        targets = [total_power / len(teams)] * len(teams)
+    else:
+        targets = [s.power for s in stats]
+    scale = POWER_WEIGHT / max(1.0, total_power / len(teams)) ** 2
+
+    def team_cost(counts, leaders, power, target):
+        return _role_penalty(counts, leaders, caps) + scale * (power - target) ** 2
+
+    costs = [team_cost(s.counts, s.leaders, s.power, t) for s, t in zip(stats, targets)]
+    current = sum(costs)
+    best = current
+    # Swaps made since the best assignment; undone at the end instead of copying every team on each new best
+    since_best = []
+
+    num_members = sum(len(team) for team in teams)
+    use_clock = max_iterations is None
+    max_iterations = min(max(2000, 400 * num_members), max_iterations if max_iterations is not None else math.inf)
+    start_temperature = 1.0 if balance_power else 0.0
+    started = time.perf_counter()
+    # The wall clock is a hard limit even when `max_iterations` is given
+    if deadline is None:
+        deadline = started + time_budget
+    progress = 0.0
+
+    for iteration in range(max_iterations):
+        if best <= 1e-9:
+            break
+        if not use_clock:
+            progress = iteration / max_iterations
+        if iteration & 255 == 0:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            if use_clock:
+                # Cool down by whichever runs out first: iterations or time
+                progress = max(iteration / max_iterations, (now - started) / max(deadline - started, 1e-9))
+        temperature = start_temperature * (1.0 - progress)
+
+        i, j = rng.sample(range(len(teams)), 2)
+        a = rng.randrange(len(teams[i]))
+        b = rng.randrange(len(teams[j]))
+        member_a = teams[i][a]
+        member_b = teams[j][b]
+        delta_leaders = (member_b.name in leader_names) - (member_a.name in leader_names)
+        if member_a.profession == member_b.profession and not delta_leaders and not balance_power:
+            continue
+
+        delta_power = member_b.power - member_a.power
+        counts_i = _swapped_counts(stats[i].counts, member_a.profession, member_b.profession)
+        counts_j = _swapped_counts(stats[j].counts, member_b.profession, member_a.profession)
+        cost_i = team_cost(counts_i, stats[i].leaders + delta_leaders, stats[i].power + delta_power, targets[i])
+        cost_j = team_cost(counts_j, stats[j].leaders - delta_leaders, stats[j].power - delta_power, targets[j])
+        delta = cost_i + cost_j - costs[i] - costs[j]
+
+        if delta < 0 or (temperature > 0 and rng.random() < math.exp(-delta / temperature)):
+            teams[i][a], teams[j][b] = member_b, member_a
+            since_best.append((i, a, j, b))
+            stats[i].counts, stats[j].counts = counts_i, counts_j
+            stats[i].leaders += delta_leaders
+            stats[j].leaders -= delta_leaders
+            stats[i].power += delta_power
+            stats[j].power -= delta_power
+            costs[i], costs[j] = cost_i, cost_j
+            current += delta
+            if current < best - 1e-9:
+                best = current
+                since_best.clear()
+
+    for i, a, j, b in reversed(since_best):
+        teams[i][a], teams[j][b] = teams[j][b], teams[i][a]
+    return best
+
+
+
+def _team_ids(team_data):
+    return team_data['members'] + ([team_data['leader']] if team_data['leader'] is not None else [])
+
+
+def _nearest_in(members):
+    """
+    Returns nearest(profession, power, count): up to `count` of `members` of that profession on each side of `power`.
+    The members are sorted once by profession and power.
+    """
+    by_profession = {}
+    for member in members:
+        by_profession.setdefault(member.profession, []).append((member.power, member.id, member))
+    for keys in by_profession.values():
+        keys.sort(key=lambda key: key[:2])
+
+    def nearest(profession, power, count):
+        keys = by_profession.get(profession, [])
+        position = bisect_left(keys, (power, -1), key=lambda key: key[:2])
+        return [member for _, _, member in keys[max(0, position - count):position + count]]
+    return nearest
+
+
+def repair_groups(teams, members_by_id, joined, left, leader_candidates, max_sages, max_knights, max_swordsmen,
+                  group_type='balance', pinned=(), max_moves=None):
+    """
+    Repairs a stored grouping (`teams` as returned by form_groups, resolved with `members_by_id`) after
+    the members in `joined` (Member objects) arrive and the member ids in `left` go, changing as little
+    as possible. Leavers are taken out. Teams left with fewer than 3 members are broken up, except pinned
+    teams, whose holes are filled instead (a pinned team is kept even if nobody is left to fill them). Newcomers and the members of broken-up teams fill the holes of
+    the touched teams first (3 or more left over form new teams, 1 or 2 join the touched team where they fit
+    best, or else the weakest team as in create_groups). Then at most `max_moves` swaps (by default one per
+    joined or left member) repair the touched teams: a swap must fix a role cap, missing role or missing
+    leader, or else cut the power objective by more than REPAIR_MIN_POWER_GAIN. Teams only changed by a swap
+    are not repaired in turn, so the change never spreads beyond the touched teams and their swap partners.
+
+    Power is pulled toward the same targets as in optimize_teams: the average team power for balance and
+    carry groupings, and each team's own power before the change for high_power (so that its tiers are
+    kept). The `pinned` teams (form_groups' 'pinned': the fixed and carry teams) only get their holes
+    filled, toward their own power before the change; they are never swapped with and do not take extra members.
+
+    Team numbers are kept: a new team takes the place of a broken-up one, and only if none is formed does
+    the last team move into the gap. Changed teams keep their leader while it stays in the team.
+
+    Apart from one pass over the stored ids (the team and power of each team) and sorting the grouped members
+    by profession and power once, the work depends on the size of the change: only the touched teams and their
+    swap partners are resolved, and a swap only pairs a member of a touched team with the few grouped members
+    closest to the wanted power in each profession.
+    Returns the same shape as form_groups, except that 'score' only covers the changed teams, plus 'moves',
+    [(member id, new team index or None), ...] for every member whose team (or team number) changed, 'changed',
+    the indexes of the teams that differ from `teams`, and 'pinned', the new indexes of the pinned teams.
+    """
+    caps = {'賢者': max_sages, '騎士': max_knights, '剣士': max_swordsmen}
+    leader_set = set(leader_candidates)
+    left = set(left)
+    pinned = set(pinned)
+    if max_moves is None:
+        max_moves = len(joined) + len(left)
+
+    # The one pass over the grouping: the team of every member, and each team's size and power before the change
+    team_of = {}
+    sizes = []
+    powers = []
+    for index, team_data in enumerate(teams):
+        ids = _team_ids(team_data)
+        for member_id in ids:
+            team_of[member_id] = index
+        sizes.append(len(ids))
+        powers.append(sum(members_by_id[member_id].power for member_id in ids if member_id in members_by_id))
+    own_targets = list(powers)
+    # Swap partners are only looked up among the grouped members and the newcomers, as nobody else can be swapped
+    nearest = _nearest_in([members_by_id[member_id] for member_id in team_of if member_id in members_by_id] + list(joined))
+
+    groups = {}  # index -> member list (leader included), only for the teams resolved so far
+    stats = {}
+    broken = set()
+    origin = {}  # member id -> team index before the change (None for newcomers), for the members that moved
+
+    def group(index):
+        if index not in groups:
+            groups[index] = [members_by_id[member_id] for member_id in _team_ids(teams[index]) if member_id not in left]
+        return groups[index]
+
+    def stat(index):
+        if index not in stats:
+            stats[index] = _TeamStats(group(index), leader_set)
+        return stats[index]
+
+    def move(member, index):
+        origin.setdefault(member.id, team_of.get(member.id))
+        if index is None:
+            team_of.pop(member.id, None)
+        else:
+            team_of[member.id] = index
+
+    def refresh(index):
+        stats[index] = _TeamStats(groups[index], leader_set)
+        sizes[index] = len(groups[index])
+        powers[index] = stats[index].power
+        changed.add(index)
+
+    # Touched teams lost or gained members; only they are repaired. Changed teams also include swap partners.
+    touched = set()
+    changed = set()
+    for member_id in left:
+        if member_id in team_of:
+            touched.add(team_of[member_id])
+            origin[member_id] = team_of.pop(member_id)
+    for index in touched:
+        group(index)
+        refresh(index)
+
+    # Teams that became too small are broken up and their members placed again with the newcomers.
+    # Pinned teams are only dropped once empty, and the only team is kept with 1 or 2 members.
+    floating = list(joined)
+    for index in sorted(touched):
+        if not groups[index] or (len(groups[index]) < 3 and index not in pinned and len(teams) > 1):
+            floating.extend(groups[index])
+            for member in groups[index]:
+                move(member, None)
+            broken.add(index)
+    touched -= broken
+    changed -= broken
+
+    def balanced_mean():
+        # Pinned teams are left out of the average, as they are formed outside the optimizer
+        live = [index for index in range(len(powers)) if index not in broken]
+        balanced = [powers[index] for index in live if index not in pinned] or [powers[index] for index in live]
+        return sum(balanced) / max(1, len(balanced))
+
+    def target(index):
+        if group_type != 'high_power' and index not in pinned:
+            return mean
+        return own_targets[index]
+
+    def power_cost(index, power):
+        return scale * (power - target(index)) ** 2
+
+    def added_cost(index, member):
+        s = stat(index)
+        counts = dict(s.counts)
+        counts[member.profession] = counts.get(member.profession, 0) + 1
+        leaders = s.leaders + (member.name in leader_set)
+        return (
+            _role_penalty(counts, leaders, caps) + power_cost(index, s.power + member.power)
+            - _role_penalty(s.counts, s.leaders, caps) - power_cost(index, s.power)
+        )
+
+    def place(index, member):
+        group(index).append(member)
+        move(member, index)
+        refresh(index)
+        touched.add(index)
+
+    mean = balanced_mean()
+    scale = POWER_WEIGHT / max(1.0, mean) ** 2
+
+    # Fill the holes of the touched teams, strongest first, each member where it adds the least cost
+    floating.sort(key=lambda member: (-member.power, member.id))
+    unplaced = []
+    for member in floating:
+        holes = [index for index in touched if len(groups[index]) < 4]
+        if holes:
+            place(min(holes, key=lambda index: (added_cost(index, member), index)), member)
+        else:
+            unplaced.append(member)
+
+    # As in create_groups: teams of 4, a team of 3 from 3 left over, and 1 or 2 added to existing teams
+    while len(unplaced) >= 3:
+        new_group, unplaced = unplaced[:4], unplaced[4:]
+        index = len(powers)
+        groups[index] = new_group
+        sizes.append(len(new_group))
+        powers.append(0)
+        for member in new_group:
+            move(member, index)
+        refresh(index)
+        touched.add(index)
+        # A new team is a high_power tier of its own
+        own_targets.append(powers[index])
+    leftover = []
+    for member in unplaced:
+        candidates = [index for index in touched if sizes[index] < 5 and index not in pinned]
+        if not candidates:
+            weakest = min(
+                (index for index in range(len(sizes)) if sizes[index] < 5 and index not in pinned and index not in broken),
+                key=lambda index: (powers[index], index), default=None
+            )
+            candidates = [weakest] if weakest is not None else []
+        if candidates:
+            place(min(candidates, key=lambda index: (added_cost(index, member), index)), member)
+        else:
+            leftover.append(member)
+
+    if len(broken) == len(powers):
+        raise GroupingError('⚠️ 再編成できるチームがありません。`/auto_create_group` でグループを作り直してください。')
+    mean = balanced_mean()
+    scale = POWER_WEIGHT / max(1.0, mean) ** 2
+
+    # Local repair of the touched teams: the best swap with another team that fixes roles (or, failing that,
+    # gains enough power balance), until none is left. Role fixes come first.
+    for _ in range(max_moves):
+        best = None
+        for i in sorted(touched):
+            if i in pinned:
+                continue
+            s_i = stat(i)
+            role_i = _role_penalty(s_i.counts, s_i.leaders, caps)
+            for member_a in groups[i]:
+                wanted = member_a.power + (target(i) - s_i.power)
+                for profession in PROFESSIONS:
+                    for candidate in nearest(profession, wanted, REPAIR_NEIGHBOURS):
+                        j = team_of.get(candidate.id)
+                        if j is None or j == i or j in pinned:
+                            continue
+                        member_b = members_by_id.get(candidate.id, candidate)
+                        s_j = stat(j)
+                        delta_leaders = (member_b.name in leader_set) - (member_a.name in leader_set)
+                        delta_power = member_b.power - member_a.power
+                        role_gain = (
+                            role_i + _role_penalty(s_j.counts, s_j.leaders, caps)
+                            - _role_penalty(_swapped_counts(s_i.counts, member_a.profession, member_b.profession), s_i.leaders + delta_leaders, caps)
+                            - _role_penalty(_swapped_counts(s_j.counts, member_b.profession, member_a.profession), s_j.leaders - delta_leaders, caps)
+                        )
+                        power_gain = (
+                            power_cost(i, s_i.power) + power_cost(j, s_j.power)
+                            - power_cost(i, s_i.power + delta_power) - power_cost(j, s_j.power - delta_power)
+                        )
+                        if role_gain < 0 or (role_gain == 0 and power_gain <= REPAIR_MIN_POWER_GAIN) or role_gain + power_gain <= 0:
+                            continue
+                        key = (role_gain, power_gain)
+                        if best is None or key > best[0]:
+                            best = (key, i, member_a, j, member_b)
+        if best is None:
+            break
+        _, i, member_a, j, member_b = best
+        groups[i][groups[i].index(member_a)] = member_b
+        groups[j][groups[j].index(member_b)] = member_a
+        move(member_a, j)
+        move(member_b, i)
+        refresh(i)
+        refresh(j)
+
+    # Team numbers: new teams fill the places of broken-up ones, then the last teams move into any gap left
+    order = list(range(len(teams)))
+    new_teams = list(range(len(teams), len(powers)))
+    for index in sorted(broken):
+        order[index] = new_teams.pop(0) if new_teams else None
+    order += new_teams
+    while None in order:
+        last = order.pop()
+        if last is not None:
+            order[order.index(None)] = last
+    new_index = {index: position for position, index in enumerate(order)}
+    relocated = {index for index in order if index < len(teams) and new_index[index] != index}
+
+    # Unchanged teams are copied as stored; changed ones keep their leader while it stays in the team,
+    # and otherwise get their strongest leader candidate, as in form_groups
+    result_teams = []
+    changed_teams = []
+    for index in order:
+        if index not in changed:
+            result_teams.append(teams[index])
+            continue
+        stored = teams[index]['leader'] if index < len(teams) else None
+        leader = next((member for member in groups[index] if member.id == stored), None)
+        if leader is None:
+            leaders = [member for member in groups[index] if member.name in leader_set]
+            leader = max(leaders, key=lambda member: member.power) if leaders else None
+        changed_teams.append({'members': [member for member in groups[index] if member is not leader], 'leader': leader})
+        result_teams.append({'leader': leader.id if leader else None, 'members': [m.id for m in changed_teams[-1]['members']]})
+
+    # Members of a team that moved to another number count as moved too
+    for index in relocated:
+        for member_id in _team_ids(teams[index]):
+            origin.setdefault(member_id, index)
+    moves = []
+    for member_id, old_index in origin.items():
+        index = team_of.get(member_id)
+        position = new_index[index] if index is not None else None
+        if position != old_index:
+            moves.append((member_id, position))
+
+    return {
+        'teams': result_teams,
+        'leftover': [member.id for member in leftover],
+        'score': score_grouping(changed_teams, caps),
+        'moves': moves,
+        'changed': sorted(new_index[index] for index in changed | relocated),
+        'pinned': sorted(new_index[index] for index in pinned if index in new_index)
+    }
@@ -0,0 +1,125 @@
+import json
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+# Size of the shared memory segment holding one health snapshot
+HEALTH_SEGMENT_SIZE = 64 * 1024
+# Segment layout: sequence number (odd while a write is in progress), payload length, JSON payload
+_HEADER = struct.Struct('<QI')
+
+
+def _attach(name):
+    segment = shared_memory.SharedMemory(name=name)
+    # Python < 3.13 registers attached segments with the resource tracker, which would unlink the
+    # segment when this (reading) process exits; only the bot owns it
+    try:
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    except Exception:
+        pass
+    return segment
+
+
+class HealthPublisher:
+    """
+    Publishes the bot's health snapshot (a JSON-serializable dict) to a named shared memory segment.
+    Writes are guarded by a sequence number, so readers never need to lock or talk to the bot.
+    """
+
+    def __init__(self, name, size=HEALTH_SEGMENT_SIZE):
+        self.name = name
+        try:
+            self._segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a previous run of the bot
+            self._segment = _attach(name)
+        self._sequence = _HEADER.unpack_from(self._segment.buf)[0] & ~1
+
+    def publish(self, snapshot):
+        payload = json.dumps(dict(snapshot, updated=time.time()), ensure_ascii=False).encode()
+        if _HEADER.size + len(payload) > self._segment.size:
+            payload = json.dumps({'updated': time.time(), 'error': 'health snapshot too large'}).encode()
+        buf = self._segment.buf
+        _HEADER.pack_into(buf, 0, self._sequence + 1, 0)
+        buf[_HEADER.size:_HEADER.size + len(payload)] = payload
+        self._sequence += 2
+        _HEADER.pack_into(buf, 0, self._sequence, len(payload))
+
+    def close(self):
+        """Marks the bot as stopped, then releases and removes the segment."""
+        self.publish({'stopped': True})
+        self._segment.close()
+        try:
+            self._segment.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class HealthReader:
+    """Reads the snapshot published by HealthPublisher; attaches lazily and re-attaches after a bot restart."""
+
+    def __init__(self, name, retries=5):
+        self.name = name
+        self.retries = retries
+        self._segment = None
+
+    def read(self):
+        """Returns the latest snapshot, or None if the bot has not published one."""
+        if self._segment is None:
+            try:
+                self._segment = _attach(self.name)
+            except FileNotFoundError:
+                return None
+        buf = self._segment.buf
+        for _ in range(self.retries):
+            sequence, length = _HEADER.unpack_from(buf)
+            if sequence == 0:
+                return None
+            if sequence & 1:
+                time.sleep(0.001)
+                continue
+            payload = bytes(buf[_HEADER.size:_HEADER.size + length])
+            if _HEADER.unpack_from(buf)[0] == sequence:
+                try:
+                    return json.loads(payload)
+                except ValueError:
+                    return None
+        return None
+
+    def reset(self):
+        """Drops the attached segment (e.g. when the snapshot is stale, the bot may have recreated it)."""
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+
+def check_health(snapshot, max_age, max_loop_lag):
+    """Liveness: the bot published recently and its event loop is not stalled. Returns a list of problems."""
+    if snapshot is None:
+        return ['no health data published']
+    if snapshot.get('stopped'):
+        return ['bot has stopped']
+    problems = []
+    age = time.time() - snapshot.get('updated', 0)
+    if age > max_age:
+        problems.append(f'health data is {age:.0f}s old')
+    if snapshot.get('loop_lag', 0) > max_loop_lag:
+        problems.append(f'event loop lag {snapshot["loop_lag"]:.2f}s')
+    if snapshot.get('error'):
+        problems.append(snapshot['error'])
+    return problems
+
+
+def check_ready(snapshot, max_age, max_loop_lag, max_latency):
+    """Readiness: healthy, connected to the gateway on every shard and with an acceptable heartbeat latency."""
+    problems = check_health(snapshot, max_age, max_loop_lag)
+    if snapshot is None:
+        return problems
+    if not snapshot.get('ready'):
+        problems.append('bot is not ready')
+    for shard in snapshot.get('shards', []):
+        if shard.get('closed'):
+            problems.append(f'shard {shard["id"]} is disconnected')
+        elif shard.get('latency') is not None and shard['latency'] > max_latency:
+            problems.append(f'shard {shard["id"]} heartbeat latency {shard["latency"]:.2f}s')
+    return problems
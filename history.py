@@ -0,0 +1,136 @@
+import datetime
+
+import numpy as np
+
+from storage import HISTORY_UTC_OFFSET
+
+# Time zone used to read and show history dates
+TIMEZONE = datetime.timezone(datetime.timedelta(seconds=HISTORY_UTC_OFFSET))
+# Percentiles shown by power_percentiles
+PERCENTILES = (10, 25, 50, 75, 90)
+
+
+class PowerState:
+    """
+    Powers of a guild's members at one point in time, as columns: member ids (sorted),
+    powers and professions. Built from the roster (now) or from a stored snapshot (as_of).
+    """
+
+    __slots__ = ('ids', 'powers', 'professions')
+
+    def __init__(self, ids, powers, professions):
+        order = np.argsort(ids, kind='stable')
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.powers = np.asarray(powers, dtype=np.int64)[order]
+        self.professions = np.asarray(professions, dtype=object)[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_roster(cls, roster):
+        members = list(roster)
+        return cls([m.id for m in members], [m.power for m in members], [m.profession for m in members])
+
+    @classmethod
+    def as_of(cls, storage, guild_id, ts):
+        """
+        Rebuilds the powers at time `ts` from the latest snapshot before it and the changes since
+        (at most about a day of them). Returns None if no history goes back that far.
+        """
+        snapshot = storage.load_power_snapshot(guild_id, ts)
+        if snapshot is None:
+            return None
+        start, ids, powers, professions = snapshot
+        state = cls(np.frombuffer(ids, dtype=np.int64), np.frombuffer(powers, dtype=np.int64), professions)
+        changes = {}
+        for member_id, profession, power in storage.load_power_changes(guild_id, start, ts):
+            changes[member_id] = (profession, power)
+        if changes:
+            state._apply(changes)
+        return state
+
+    def _apply(self, changes):
+        """Applies {member_id: (profession, power or None)} (None removes the member)."""
+        changed_ids = np.fromiter(changes, dtype=np.int64, count=len(changes))
+        positions = np.searchsorted(self.ids, changed_ids)
+        if len(self.ids):
+            found = self.ids[np.minimum(positions, len(self.ids) - 1)] == changed_ids
+        else:
+            found = np.zeros(len(changed_ids), dtype=bool)
+        keep = np.ones(len(self.ids), dtype=bool)
+        added = []
+        for member_id, position, exists in zip(changed_ids.tolist(), positions.tolist(), found.tolist()):
+            profession, power = changes[member_id]
+            if power is None:
+                if exists:
+                    keep[position] = False
+            elif exists:
+                self.powers[position] = power
+                self.professions[position] = profession
+            else:
+                added.append((member_id, power, profession))
+        ids, powers, professions = self.ids[keep], self.powers[keep], self.professions[keep]
+        if added:
+            ids = np.concatenate([ids, [row[0] for row in added]])
+            powers = np.concatenate([powers, [row[1] for row in added]])
+            professions = np.concatenate([professions, np.array([row[2] for row in added], dtype=object)])
+        PowerState.__init__(self, ids, powers, professions)
+
+    def ranking(self, profession=None):
+        """Returns the indexes of the members (of one profession) by power, highest first (ties by id)."""
+        indexes = np.arange(len(self.ids)) if profession is None else np.flatnonzero(self.professions == profession)
+        return indexes[np.lexsort((self.ids[indexes], -self.powers[indexes]))]
+
+    def rank_of(self, member_id):
+        """Returns (power, profession, overall rank, member count, profession rank, profession count) or None."""
+        position = np.searchsorted(self.ids, member_id)
+        if position >= len(self.ids) or self.ids[position] != member_id:
+            return None
+        power = int(self.powers[position])
+        profession = self.professions[position]
+        same = self.professions == profession
+        # Members ahead: higher power, or the same power and a lower id (the ranking's tie order)
+        ahead = (self.powers > power) | ((self.powers == power) & (self.ids < member_id))
+        return power, profession, int(ahead.sum()) + 1, len(self.ids), int((ahead & same).sum()) + 1, int(same.sum())
+
+    def percentiles(self, profession, points=PERCENTILES):
+        """Returns the nearest-rank percentiles of a profession's powers, or None if nobody has it."""
+        powers = np.sort(self.powers[self.professions == profession])
+        if not len(powers):
+            return None
+        return [int(powers[max(0, int(np.ceil(point / 100 * len(powers))) - 1)]) for point in points]
+
+
+def top_gainers(then, now, count, profession=None):
+    """
+    Returns [(member_id, power then, power now)] of the `count` members (of `profession` now) whose power
+    rose the most from state `then` to state `now`. Members missing from either state are left out.
+    """
+    common, then_index, now_index = np.intersect1d(then.ids, now.ids, assume_unique=True, return_indices=True)
+    if profession is not None:
+        mask = now.professions[now_index] == profession
+        common, then_index, now_index = common[mask], then_index[mask], now_index[mask]
+    gains = now.powers[now_index] - then.powers[then_index]
+    order = np.lexsort((common, -gains))[:count]
+    return [(int(common[i]), int(then.powers[then_index[i]]), int(now.powers[now_index[i]])) for i in order]
+
+
+def roster_percentiles(roster, profession, points=PERCENTILES):
+    """Nearest-rank percentiles of a profession's current powers, read from the roster's sorted index."""
+    count = roster.count(profession)
+    if not count:
+        return None
+    # by_profession is sorted highest first, so the p-th percentile is counted from the end
+    return [roster.by_profession(profession, count - rank, count - rank + 1)[0].power
+            for rank in (max(1, int(np.ceil(point / 100 * count))) for point in points)]
+
+
+def parse_date(text):
+    """Returns the end (unix time) of the day `text` (YYYY-MM-DD, Japan time); raises ValueError if invalid."""
+    day = datetime.datetime.strptime(text.strip(), '%Y-%m-%d').replace(tzinfo=TIMEZONE)
+    return (day + datetime.timedelta(days=1)).timestamp()
+
+
+def format_time(ts):
+    return datetime.datetime.fromtimestamp(ts, TIMEZONE).strftime('%Y-%m-%d %H:%M')
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from metrics import REGISTRY, RUNNING_COMMANDS
+
+REGISTRY.describe('event_loop_lag_seconds', 'histogram', 'How late the watchdog heartbeat ran on the event loop.')
+REGISTRY.describe('event_loop_stalls_total', 'counter', 'Event loop stalls longer than the watchdog threshold.')
+
+
+class LoopWatchdog:
+    """
+    Measures event loop lag with a heartbeat scheduled every `interval` seconds. A background thread
+    notices when the heartbeat is more than `threshold` seconds late, captures the stack of the event
+    loop thread (the code that is blocking it) and the slash command being run, and appends the report
+    to a JSON Lines file once the loop has recovered. Only a `sample_rate` fraction of stalls is reported.
+    """
+
+    def __init__(self, threshold=0.25, interval=0.1, sample_rate=1.0, report_path=None, max_reports=100):
+        self.threshold = threshold
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.report_path = report_path
+        self.reports = deque(maxlen=max_reports)  # most recent finished reports
+        self._loop = None
+        self._loop_thread_id = None
+        self._expected = None    # loop.time() at which the next heartbeat is due
+        self._last_beat = None   # time.monotonic() of the last heartbeat
+        self._max_lag = 0.0      # largest lag since the last max_lag() call
+        self._pending = None     # report of the stall in progress
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, loop):
+        """Starts the heartbeat on `loop` (call from the loop's thread) and the watchdog thread."""
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._expected = loop.time() + self.interval
+        loop.call_later(self.interval, self._beat)
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def max_lag(self):
+        """Returns the largest lag seen since the previous call."""
+        with self._lock:
+            lag, self._max_lag = self._max_lag, 0.0
+        return lag
+
+    def _beat(self):
+        lag = max(0.0, self._loop.time() - self._expected)
+        with self._lock:
+            self._last_beat = time.monotonic()
+            self._max_lag = max(self._max_lag, lag)
+            if self._pending is not None:
+                self._pending['lag'] = max(self._pending['lag'], lag)
+        REGISTRY.observe('event_loop_lag_seconds', lag)
+        if not self._stop.is_set():
+            self._expected = self._loop.time() + self.interval
+            self._loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval / 2):
+            now = time.monotonic()
+            finished = None
+            with self._lock:
+                blocked = now - self._last_beat - self.interval
+                if self._pending is not None:
+                    if self._last_beat > self._pending['detected']:
+                        finished, self._pending = self._pending, None
+                elif blocked > self.threshold:
+                    self._pending = self._capture(now, blocked)
+            if finished is not None:
+                self._finish(finished)
+
+    def _capture(self, now, blocked):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        task = asyncio.current_task(self._loop)
+        command = RUNNING_COMMANDS.get(task)
+        REGISTRY.inc('event_loop_stalls_total', command=command or '')
+        return {
+            'time': time.time(),
+            'detected': now,
+            'command': command,
+            'task': task.get_name() if task is not None else None,
+            'lag': blocked,
+            'stack': traceback.format_stack(frame) if frame is not None else [],
+            'sampled': random.random() < self.sample_rate
+        }
+
+    def _finish(self, report):
+        if not report.pop('sampled'):
+            return
+        report.pop('detected')
+        self.reports.append(report)
+        if self.report_path:
+            try:
+                with open(self.report_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(report, ensure_ascii=False) + '\n')
+            except OSError:
+                pass
@@ -0,0 +1,179 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# (command name, perf_counter at handler start) of the command running in the current task
+_current_command = contextvars.ContextVar('current_command', default=None)
+# asyncio task -> name of the command it is running (readable from other threads, see loop_watchdog)
+RUNNING_COMMANDS = {}
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and two additions."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """
+    In-process metrics (counters and histograms keyed by name and labels), rendered in the
+    Prometheus text format. The bot dumps it to a file that web.py serves at /metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}        # name -> (type, help text)
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._counters = {}    # (name, labels) -> value
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            histograms = {key: (list(h.counts), h.sum, h.count, h.buckets) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                kind, text = self._help.get(name, (kind, ''))
+                if text:
+                    lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{_labels(labels)} {value}')
+        for (name, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """Writes the rendered metrics to `path` atomically (readers never see a partial file)."""
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = Registry()
+REGISTRY.describe('command_latency_seconds', 'histogram', 'Time from handler start to handler return.')
+REGISTRY.describe('command_time_to_defer_seconds', 'histogram', 'Time from handler start to the deferred response.')
+REGISTRY.describe('command_stage_seconds', 'histogram', 'Time spent in one stage (computation, rendering, Discord API) of a command.')
+REGISTRY.describe('command_errors_total', 'counter', 'Commands whose handler raised an exception.')
+
+
+def instrumented(func):
+    """
+    Decorator for slash command handlers: records the handler latency and counts the errors,
+    labelled with the handler's name. Use mark_deferred() and stage() inside the handler for details.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        token = _current_command.set((name, start))
+        task = asyncio.current_task()
+        RUNNING_COMMANDS[task] = name
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            REGISTRY.inc('command_errors_total', command=name)
+            raise
+        finally:
+            REGISTRY.observe('command_latency_seconds', time.perf_counter() - start, command=name)
+            _current_command.reset(token)
+            RUNNING_COMMANDS.pop(task, None)
+    return wrapper
+
+
+def mark_deferred():
+    """Records the time from the start of the current command until now (call right after defer())."""
+    current = _current_command.get()
+    if current is not None:
+        REGISTRY.observe('command_time_to_defer_seconds', time.perf_counter() - current[1], command=current[0])
+
+
+@contextmanager
+def stage(stage_name):
+    """Records the duration of the `with` block as one stage of the current command."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current = _current_command.get()
+        REGISTRY.observe(
+            'command_stage_seconds', time.perf_counter() - start,
+            command=current[0] if current else '', stage=stage_name
+        )
+
+
+def start_logging(level=logging.INFO):
+    """
+    Routes all logging through a queue: the event loop only enqueues records, and a background
+    thread writes them to stdout. Returns the QueueListener (stop() it on shutdown to drain the queue).
+    """
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+    listener.start()
+    return listener
@@ -0,0 +1,89 @@
+import discord
+
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+# Room left in each page for the page counter
+FOOTER_RESERVE = 20
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """
+    Splits `text` at line boundaries into chunks of at most `limit` characters.
+    A single line longer than `limit` is cut into several chunks.
+    """
+    chunks = []
+    current = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(''.join(current))
+                current = []
+                size = 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if size + len(line) > limit:
+            chunks.append(''.join(current))
+            current = []
+            size = 0
+        current.append(line)
+        size += len(line)
+    if current:
+        chunks.append(''.join(current))
+    return chunks or ['']
+
+
+class Paginator(discord.ui.View):
+    """
+    Button-driven pagination. `render_page(index)` is only called for the page being shown,
+    so large rosters are never rendered as a whole.
+    """
+
+    def __init__(self, render_page, page_count, timeout=300):
+        super().__init__(timeout=timeout)
+        self.render_page = render_page
+        self.page_count = page_count
+        self.page = 0
+        self._update_buttons()
+
+    def content(self):
+        text = self.render_page(self.page)
+        return f'{text[:MESSAGE_LIMIT - FOOTER_RESERVE]}\n({self.page + 1}/{self.page_count})'
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    async def _show(self, interaction, page):
+        self.page = max(0, min(page, self.page_count - 1))
+        self._update_buttons()
+        await interaction.response.edit_message(content=self.content(), view=self)
+
+    @discord.ui.button(label='◀', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label='▶', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page + 1)
+
+
+async def send_paginated(send, render_page, page_count):
+    """
+    Sends the first page with `send` (interaction.response.send_message or interaction.followup.send),
+    attaching page buttons when there is more than one page.
+    """
+    if page_count <= 1:
+        await send(render_page(0)[:MESSAGE_LIMIT])
+        return
+    view = Paginator(render_page, page_count)
+    await send(view.content(), view=view)
+
+
+async def send_text(send, text):
+    """Sends already rendered text, paginated at line boundaries when it is too long for one message."""
+    if len(text) <= MESSAGE_LIMIT:
+        await send(text)
+        return
+    pages = split_message(text, MESSAGE_LIMIT - FOOTER_RESERVE)
+    await send_paginated(send, pages.__getitem__, len(pages))
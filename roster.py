@@ -0,0 +1,188 @@
+import sys
+from bisect import bisect_left, insort
+from itertools import islice
+
+
+class Member:
+    """
+    One roster member. `id` is the registration sequence number: unique within the roster and
+    stable for the member's lifetime (renames and power changes keep it), so teams and results
+    can refer to members by id. Profession strings are interned, so every member of a profession
+    shares one string object.
+    """
+
+    __slots__ = ('id', 'name', 'profession', 'power')
+
+    def __init__(self, id, name, profession, power):
+        self.id = id
+        self.name = name
+        self.profession = sys.intern(profession)
+        self.power = power
+
+    def __repr__(self):
+        return f'Member({self.id}, {self.name!r}, {self.profession!r}, {self.power})'
+
+    def __reduce__(self):
+        # Pickled as a plain argument tuple (members are sent to the grouping worker processes)
+        return Member, (self.id, self.name, self.profession, self.power)
+
+    def as_dict(self):
+        return {'name': self.name, 'profession': self.profession, 'power': self.power}
+
+
+class Roster:
+    """
+    Member roster with a name index and power-sorted indexes (overall and per profession).
+    Every change is applied to the indexes with a single bisect insert/delete,
+    so lookups never scan the whole list and rankings are never rebuilt.
+    """
+
+    def __init__(self, members=(), next_id=0):
+        self._order = {}          # id -> Member (registration order, used by member_list)
+        self._by_name = {}        # name -> Member
+        self._power_keys = []     # sorted [(-power, id)] for the overall ranking
+        self._profession_keys = {}  # profession -> sorted [(-power, id)]
+        # Ids are never handed out twice, even after the member holding the highest one is removed:
+        # `next_id` is the stored high-water mark (see Storage.load_next_member_id)
+        self._next_id = next_id
+        self._listeners = []
+        self.version = 0  # bumped on every change
+        for member in members:
+            self.add(member['name'], member['profession'], member['power'], member_id=member.get('seq'))
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __iter__(self):
+        return iter(list(self._order.values()))
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def slice(self, start, stop):
+        """Returns the members from `start` to `stop` in registration order."""
+        return list(islice(self._order.values(), start, stop))
+
+    def count(self, profession=None):
+        """Returns the number of members, or of members of one profession."""
+        if profession is None:
+            return len(self._by_name)
+        return len(self._profession_keys.get(profession, []))
+
+    def get(self, name):
+        """Returns the Member for `name`, or None if it is not registered."""
+        return self._by_name.get(name)
+
+    def by_id(self, member_id):
+        """Returns the Member with id `member_id`, or None if it is not registered."""
+        return self._order.get(member_id)
+
+    def names(self):
+        return list(self._by_name)
+
+    def subscribe(self, callback):
+        """
+        Registers `callback(event, member, old_name=None)`, called after every change.
+        `event` is one of 'add', 'remove', 'rename', 'power' or 'update' (profession and/or power).
+        """
+        self._listeners.append(callback)
+
+    def add(self, name, profession, power, member_id=None):
+        """Registers a new member and returns it."""
+        if name in self._by_name:
+            raise KeyError(f'{name} is already registered')
+        if member_id is None:
+            member_id = self._next_id
+        self._next_id = max(self._next_id, member_id + 1)
+        member = Member(member_id, name, profession, power)
+        self._order[member_id] = member
+        self._by_name[name] = member
+        self._insert_keys(member)
+        self._notify('add', member)
+        return member
+
+    def remove(self, name):
+        """Removes a member and returns it."""
+        member = self._by_name.pop(name)
+        del self._order[member.id]
+        self._discard_keys(member)
+        self._notify('remove', member)
+        return member
+
+    def rename(self, old_name, new_name):
+        """Renames a member in place, keeping its id and its position in every index."""
+        if new_name in self._by_name:
+            raise KeyError(f'{new_name} is already registered')
+        member = self._by_name.pop(old_name)
+        member.name = new_name
+        self._by_name[new_name] = member
+        self._notify('rename', member, old_name)
+        return member
+
+    def set_power(self, name, power):
+        """Updates a member's power and re-keys it in the power index."""
+        member = self._by_name[name]
+        self._discard_keys(member)
+        member.power = power
+        self._insert_keys(member)
+        self._notify('power', member)
+        return member
+
+    def apply_batch(self, upserts, removals=()):
+        """
+        Applies many changes at once: `upserts` is an iterable of (name, profession, power), adding new
+        members and updating existing ones; `removals` is an iterable of names to remove.
+        The power indexes are rebuilt with one sort at the end instead of one bisect per change.
+        Listeners are notified of every change after the indexes are rebuilt.
+        Returns the lists of added, updated and removed members.
+        """
+        events = []
+        for name in removals:
+            member = self._by_name.pop(name)
+            del self._order[member.id]
+            events.append(('remove', member))
+        for name, profession, power in upserts:
+            member = self._by_name.get(name)
+            if member is None:
+                member = Member(self._next_id, name, profession, power)
+                self._next_id += 1
+                self._order[member.id] = member
+                self._by_name[name] = member
+                events.append(('add', member))
+            elif member.profession != profession or member.power != power:
+                member.profession = sys.intern(profession)
+                member.power = power
+                events.append(('update', member))
+        self._rebuild_keys()
+        for event, member in events:
+            self._notify(event, member)
+        return [[member for event, member in events if event == kind] for kind in ('add', 'update', 'remove')]
+
+    def by_power(self, start=0, stop=None):
+        """Returns the members sorted by power (highest first), optionally only ranks `start` to `stop`."""
+        return [self._order[member_id] for _, member_id in self._power_keys[start:stop]]
+
+    def by_profession(self, profession, start=0, stop=None):
+        """Returns the members of one profession sorted by power (highest first), optionally only ranks `start` to `stop`."""
+        return [self._order[member_id] for _, member_id in self._profession_keys.get(profession, [])[start:stop]]
+
+    def _notify(self, event, member, old_name=None):
+        self.version += 1
+        for callback in self._listeners:
+            callback(event, member, old_name)
+
+    def _insert_keys(self, member):
+        key = (-member.power, member.id)
+        insort(self._power_keys, key)
+        insort(self._profession_keys.setdefault(member.profession, []), key)
+
+    def _rebuild_keys(self):
+        self._power_keys = sorted((-member.power, member_id) for member_id, member in self._order.items())
+        self._profession_keys = {}
+        for key in self._power_keys:
+            self._profession_keys.setdefault(self._order[key[1]].profession, []).append(key)
+
+    def _discard_keys(self, member):
+        key = (-member.power, member.id)
+        for keys in (self._power_keys, self._profession_keys[member.profession]):
+            del keys[bisect_left(keys, key)]
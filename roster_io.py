@@ -0,0 +1,160 @@
+import csv
+import io
+import json
+import tempfile
+
+# Column names accepted in CSV headers and JSON objects (English or the labels used in the bot's lists)
+FIELD_ALIASES = {
+    'name': 'name', '名前': 'name',
+    'profession': 'profession', '職業': 'profession',
+    'power': 'power', '戦力': 'power'
+}
+FIELDS = ('name', 'profession', 'power')
+# Exports larger than this are spooled to a temporary file instead of memory
+SPOOL_SIZE = 256 * 1024
+
+
+class RosterImportError(Exception):
+    """Raised when an import file cannot be read or validated. `errors` holds one message per problem."""
+
+    def __init__(self, errors):
+        super().__init__('\n'.join(errors))
+        self.errors = errors
+
+
+def read_rows(data, filename=''):
+    """
+    Parses an uploaded CSV or JSON file into a list of (location, row) where row maps the
+    canonical field names to raw values. JSON may be a list of objects or {"members": [...]}.
+    """
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise RosterImportError(['ファイルはUTF-8で保存してください。'])
+
+    if filename.lower().endswith('.json') or text.lstrip()[:1] in ('[', '{'):
+        try:
+            payload = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise RosterImportError([f'JSONの解析に失敗しました: {e}'])
+        if isinstance(payload, dict):
+            payload = payload.get('members')
+        if not isinstance(payload, list) or not all(isinstance(item, dict) for item in payload):
+            raise RosterImportError(['JSONはメンバーのオブジェクトの配列にしてください。'])
+        return [(f'{index + 1}件目', _canonical(item)) for index, item in enumerate(payload)]
+
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, None)
+    if header is None:
+        raise RosterImportError(['ファイルが空です。'])
+    columns = [FIELD_ALIASES.get(column.strip().lower()) for column in header]
+    missing = [field for field in FIELDS if field not in columns]
+    if missing:
+        raise RosterImportError([f'CSVのヘッダーに列がありません: {", ".join(missing)} (必要な列: name, profession, power)'])
+    rows = []
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        row = {column: value for column, value in zip(columns, values) if column}
+        rows.append((f'{reader.line_num}行目', row))
+    return rows
+
+
+def _canonical(item):
+    return {FIELD_ALIASES[key.strip().lower()]: value for key, value in item.items() if key.strip().lower() in FIELD_ALIASES}
+
+
+def validate_rows(rows, professions, name_index):
+    """
+    Validates every row in one pass and returns the records as (name, profession, power).
+    Collects all problems before raising RosterImportError: unknown professions, non-integer or
+    negative power, names given twice in the file, and names that only differ from a registered member's
+    name by width, case or kana (checked against `name_index`).
+    """
+    errors = []
+    records = []
+    seen = {}
+    for location, row in rows:
+        name = str(row.get('name') or '').strip()
+        profession = str(row.get('profession') or '').strip()
+        if not name:
+            errors.append(f'{location}: 名前が空です。')
+            continue
+        if name in seen:
+            errors.append(f'{location}: `{name}` は{seen[name]}と重複しています。')
+            continue
+        seen[name] = location
+        similar = [other for other in name_index.same_as(name) if other != name]
+        if similar:
+            errors.append(f'{location}: `{name}` は登録済みの `{similar[0]}` と表記違いです。')
+        if profession not in professions:
+            errors.append(f'{location}: `{name}` の職業 `{profession}` は無効です。利用可能な職業: {", ".join(professions)}')
+        power = _parse_power(row.get('power'))
+        if power is None or power < 0:
+            errors.append(f'{location}: `{name}` の戦力 `{row.get("power")}` は0以上の整数にしてください。')
+            continue
+        records.append((name, profession, power))
+    if errors:
+        raise RosterImportError(errors)
+    return records
+
+
+def _parse_power(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else None
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return None
+
+
+def diff_roster(roster, records, replace=False):
+    """
+    Compares the import with the current roster. Returns (added, updated, unchanged, removed):
+    `updated` holds (old record, new record) pairs; `removed` is only filled when `replace` is set.
+    """
+    added, updated, unchanged = [], [], []
+    for name, profession, power in records:
+        current = roster.get(name)
+        record = {'name': name, 'profession': profession, 'power': power}
+        if current is None:
+            added.append(record)
+        elif current.profession != profession or current.power != power:
+            updated.append((current.as_dict(), record))
+        else:
+            unchanged.append(record)
+    removed = []
+    if replace:
+        names = {name for name, _, _ in records}
+        removed = [member.as_dict() for member in roster if member.name not in names]
+    return added, updated, unchanged, removed
+
+
+def write_roster(members, file_format):
+    """
+    Writes `members` (any iterable of Members) as CSV or JSON, one member at a time, into a spooled
+    temporary file that moves to disk once it grows past SPOOL_SIZE. Returns the file rewound to the start.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    text = io.TextIOWrapper(spool, encoding='utf-8', newline='')
+    if file_format == 'json':
+        text.write('[')
+        for index, member in enumerate(members):
+            text.write(',\n  ' if index else '\n  ')
+            text.write(json.dumps(member.as_dict(), ensure_ascii=False))
+        text.write('\n]\n')
+    else:
+        # BOM so that spreadsheet applications open the Japanese names correctly
+        text.write('\ufeff')
+        writer = csv.writer(text)
+        writer.writerow(FIELDS)
+        for member in members:
+            writer.writerow([member.name, member.profession, member.power])
+    text.flush()
+    text.detach()
+    spool.seek(0)
+    return spool
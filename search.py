@@ -0,0 +1,118 @@
+import heapq
+import unicodedata
+from bisect import bisect_left, insort
+
+# Katakana (ァ..ヶ) -> hiragana, so that 'ノク' is found by 'のく'
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+
+# Longest n-gram kept in the index; longer queries intersect their n-grams of this length
+GRAM_SIZE = 3
+# Above this many candidates, substring matches are no longer ranked by match position
+RANK_LIMIT = 2000
+
+
+def normalize(text):
+    """NFKC (full/half width), case folding and katakana -> hiragana folding."""
+    return unicodedata.normalize('NFKC', text).casefold().translate(_KATAKANA_TO_HIRAGANA)
+
+
+def _grams(text):
+    grams = set()
+    for size in range(1, GRAM_SIZE + 1):
+        for start in range(len(text) - size + 1):
+            grams.add(text[start:start + size])
+    return grams
+
+
+class NameIndex:
+    """
+    Search index over member names for autocomplete: a sorted list of normalized names
+    for prefix matches and an n-gram (1 to 3 characters) index for substring matches.
+    """
+
+    def __init__(self, names=()):
+        self._normalized = {}  # name -> normalized name
+        self._sorted = []      # sorted [(normalized name, name)]
+        self._grams = {}       # n-gram -> set of names
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        key = normalize(name)
+        self._normalized[name] = key
+        insort(self._sorted, (key, name))
+        for gram in _grams(key):
+            self._grams.setdefault(gram, set()).add(name)
+
+    def remove(self, name):
+        key = self._normalized.pop(name)
+        del self._sorted[bisect_left(self._sorted, (key, name))]
+        for gram in _grams(key):
+            names = self._grams[gram]
+            names.discard(name)
+            if not names:
+                del self._grams[gram]
+
+    def roster_listener(self, event, member, old_name=None):
+        """Roster change callback that keeps the index up to date."""
+        if event == 'add':
+            self.add(member.name)
+        elif event == 'remove':
+            self.remove(member.name)
+        elif event == 'rename':
+            self.remove(old_name)
+            self.add(member.name)
+
+    def same_as(self, name):
+        """Returns the indexed names that normalize to the same key as `name` (e.g. 'ノク' and 'ﾉｸ')."""
+        key = normalize(name)
+        index = bisect_left(self._sorted, (key, ''))
+        names = []
+        while index < len(self._sorted) and self._sorted[index][0] == key:
+            names.append(self._sorted[index][1])
+            index += 1
+        return names
+
+    def search(self, query, limit=25):
+        """
+        Returns up to `limit` names containing `query`: prefix matches first (in name order),
+        then other substring matches ranked by how early the match starts.
+        """
+        key = normalize(query)
+        results = []
+
+        # Prefix matches are a contiguous range of the sorted list
+        index = bisect_left(self._sorted, (key, ''))
+        while index < len(self._sorted) and len(results) < limit:
+            normalized, name = self._sorted[index]
+            if not normalized.startswith(key):
+                break
+            results.append(name)
+            index += 1
+        if len(results) >= limit or not key:
+            return results
+
+        candidates = self._substring_candidates(key)
+        found = set(results)
+        remaining = limit - len(results)
+        if len(candidates) > RANK_LIMIT:
+            others = []
+            for name in candidates:
+                if name not in found and key in self._normalized[name]:
+                    others.append(name)
+                    if len(others) >= remaining:
+                        break
+        else:
+            others = heapq.nsmallest(
+                remaining,
+                (name for name in candidates if name not in found and key in self._normalized[name]),
+                key=lambda name: (self._normalized[name].find(key), self._normalized[name])
+            )
+        return results + others
+
+    def _substring_candidates(self, key):
+        if len(key) <= GRAM_SIZE:
+            return self._grams.get(key, set())
+        postings = [self._grams.get(key[start:start + GRAM_SIZE], set()) for start in range(len(key) - GRAM_SIZE + 1)]
+        postings.sort(key=len)
+        return set.intersection(*postings)
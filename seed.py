@@ -0,0 +1,109 @@
+import json
+import os
+
+try:
+    import msgpack
+except ImportError:  # optional: without msgpack the JSON file is parsed every time
+    msgpack = None
+
+from grouping import PROFESSIONS
+from roster_io import RosterImportError, validate_rows
+from search import NameIndex
+
+
+class SeedError(Exception):
+    """Raised when the seed file is missing or invalid."""
+
+
+def _snapshot_path(path):
+    return os.path.splitext(path)[0] + '.msgpack'
+
+
+def _validate(payload):
+    if not isinstance(payload, dict) or not isinstance(payload.get('members'), list):
+        raise SeedError('seed file must be an object with a "members" list')
+    rows = [(f'members[{index}]', item) for index, item in enumerate(payload['members']) if isinstance(item, dict)]
+    if len(rows) != len(payload['members']):
+        raise SeedError('every entry of "members" must be an object')
+    try:
+        records = validate_rows(rows, PROFESSIONS, NameIndex())
+    except RosterImportError as e:
+        raise SeedError('\n'.join(e.errors))
+    names = {name for name, _, _ in records}
+    leader_candidates = payload.get('leader_candidates', [])
+    unknown = [name for name in leader_candidates if name not in names]
+    if unknown:
+        raise SeedError(f'leader candidates not in the seed roster: {", ".join(map(str, unknown))}')
+    return {
+        'members': [{'name': name, 'profession': profession, 'power': power} for name, profession, power in records],
+        'leader_candidates': list(leader_candidates)
+    }
+
+
+def load_seed(path):
+    """
+    Loads and validates the seed roster from the JSON file at `path`.
+    When msgpack is installed, the validated seed is also written to a .msgpack snapshot next to it,
+    and later loads read that snapshot (skipping validation) for as long as it is newer than the JSON file.
+    """
+    snapshot = _snapshot_path(path)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError as e:
+        raise SeedError(f'cannot read seed file {path}: {e}')
+
+    if msgpack is not None:
+        try:
+            if os.path.getmtime(snapshot) >= mtime:
+                with open(snapshot, 'rb') as f:
+                    return msgpack.unpackb(f.read())
+        except (OSError, ValueError, msgpack.UnpackException):
+            pass  # missing or corrupt snapshot: rebuild it from the JSON file
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            payload = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SeedError(f'cannot read seed file {path}: {e}')
+    seed = _validate(payload)
+
+    if msgpack is not None:
+        try:
+            with open(snapshot + '.tmp', 'wb') as f:
+                f.write(msgpack.packb(seed))
+            os.replace(snapshot + '.tmp', snapshot)
+        except OSError:
+            pass  # the snapshot is only an optimization
+    return seed
+
+
+class SeedFile:
+    """
+    The seed roster (members and leader candidates) used to initialize new guilds.
+    reload_if_changed() re-reads the file when its modification time changes, so the seed can be
+    edited without restarting the bot.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        seed = load_seed(path)
+        self.members = seed['members']
+        self.leader_candidates = seed['leader_candidates']
+
+    def reload_if_changed(self):
+        """
+        Reloads the seed if the file was modified. Returns True if it was reloaded.
+        Raises SeedError (keeping the previous seed) if the new contents are invalid.
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        seed = load_seed(self.path)
+        self.members = seed['members']
+        self.leader_candidates = seed['leader_candidates']
+        return True
@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+# Selection categories and how they are shown to users
+CATEGORY_LABELS = {
+    'excluded': '除外メンバー',
+    'carried': 'キャリー対象',
+    'fixed': '固定メンバー',
+    'preferred': '優先メンバー'
+}
+
+
+class SelectionConflict(Exception):
+    """Raised when a member would be put in two selection categories. The message is shown to the user as is."""
+
+
+class Selection:
+    """
+    One user's selection state for auto_create_group: excluded, carried, fixed and preferred members,
+    each an ordered set of member ids (a dict with None values), plus the fixed-member probability.
+    A member can be in at most one category, which add() enforces.
+    """
+
+    __slots__ = ('excluded', 'carried', 'fixed', 'preferred', 'fixed_probability', 'last_used')
+
+    def __init__(self):
+        self.excluded = {}
+        self.carried = {}
+        self.fixed = {}
+        self.preferred = {}
+        self.fixed_probability = 1.0
+        self.last_used = time.monotonic()
+
+    def category_of(self, member_id):
+        """Returns the category `member_id` is in, or None."""
+        for category in CATEGORY_LABELS:
+            if member_id in getattr(self, category):
+                return category
+        return None
+
+    def add(self, category, member_id):
+        """
+        Adds a member to a category. Returns False if it was already there;
+        raises SelectionConflict if it is in another category.
+        """
+        current = self.category_of(member_id)
+        if current == category:
+            return False
+        if current is not None:
+            raise SelectionConflict(CATEGORY_LABELS[current])
+        getattr(self, category)[member_id] = None
+        return True
+
+    def discard(self, member_id):
+        for category in CATEGORY_LABELS:
+            getattr(self, category).pop(member_id, None)
+
+    def clear(self, category):
+        getattr(self, category).clear()
+
+    def names(self, category, roster):
+        """Returns the names of the members in a category, in the order they were added (removed members are skipped)."""
+        names = []
+        for member_id in getattr(self, category):
+            member = roster.by_id(member_id)
+            if member is not None:
+                names.append(member.name)
+        return names
+
+    def to_state(self):
+        """JSON-serializable form for Storage.save_user_state."""
+        return {
+            'excluded': list(self.excluded),
+            'carried': list(self.carried),
+            'fixed': {'members': list(self.fixed), 'probability': self.fixed_probability},
+            'preferred': list(self.preferred)
+        }
+
+    @classmethod
+    def from_state(cls, state, roster):
+        """
+        Restores a selection saved by to_state(). States saved before members were stored by id
+        hold names; those are resolved with `roster`, and unknown names are dropped.
+        """
+        selection = cls()
+        entries = {
+            'excluded': state.get('excluded', []),
+            'carried': state.get('carried', []),
+            'fixed': state.get('fixed', {}).get('members', []),
+            'preferred': state.get('preferred', [])
+        }
+        for category, values in entries.items():
+            for value in values:
+                if isinstance(value, str):
+                    member = roster.get(value)
+                    if member is None:
+                        continue
+                    value = member.id
+                # Old states may hold a name in two lists; the first category wins
+                if selection.category_of(value) is None:
+                    getattr(selection, category)[value] = None
+        selection.fixed_probability = state.get('fixed', {}).get('probability', 1.0)
+        return selection
+
+
+class SelectionStore:
+    """
+    Selection states of one guild's users, loaded from storage on first use and dropped from memory
+    after `ttl` seconds without use (evict_idle), so memory does not grow with every user who ever
+    ran a command. Saved states stay in the database and are loaded again when needed.
+    """
+
+    def __init__(self, guild_id, storage, roster, ttl):
+        self.guild_id = guild_id
+        self.storage = storage
+        self.roster = roster
+        self.ttl = ttl
+        self._selections = {}  # user_id -> Selection
+
+    def __len__(self):
+        return len(self._selections)
+
+    async def get(self, user_id):
+        """
+        Returns the user's selection, loading it from storage (or creating an empty one) if needed.
+        The load runs in a worker thread; the selection is built from it back on the event loop.
+        """
+        selection = self._selections.get(user_id)
+        if selection is None:
+            state = await asyncio.to_thread(self.storage.load_user_state, self.guild_id, user_id)
+            # Another command of the same user may have loaded it in the meantime
+            selection = self._selections.get(user_id)
+            if selection is None:
+                selection = Selection.from_state(state, self.roster) if state is not None else Selection()
+                self._selections[user_id] = selection
+        selection.last_used = time.monotonic()
+        return selection
+
+    def save(self, user_id):
+        """Queues the user's selection for the next storage flush."""
+        self.storage.save_user_state(self.guild_id, user_id, self._selections[user_id].to_state())
+
+    def roster_listener(self, event, member, old_name=None):
+        """Roster change callback: removed members are dropped from the loaded selections."""
+        if event == 'remove':
+            for selection in self._selections.values():
+                selection.discard(member.id)
+
+    def evict_idle(self):
+        """Drops the selections not used for `ttl` seconds. Returns the number evicted."""
+        deadline = time.monotonic() - self.ttl
+        idle = [user_id for user_id, selection in self._selections.items() if selection.last_used < deadline]
+        for user_id in idle:
+            del self._selections[user_id]
+        return len(idle)
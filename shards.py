@@ -0,0 +1,171 @@
+import asyncio
+import time
+
+from roster import Roster
+from cache import GroupingCache
+from search import NameIndex
+from selection import SelectionStore
+from attendance import AttendanceIndex
+
+
+class GuildShard:
+    """
+    In-memory state of one guild: roster, leader candidates, per-user selection state,
+    grouping cache, autocomplete index, Discord user to member mapping and the last grouping per channel.
+    """
+
+    def __init__(self, guild_id, storage, cache_size, selection_ttl):
+        self.guild_id = guild_id
+        self.storage = storage
+        self.last_used = time.monotonic()
+
+        # Overall ranking list (name, profession, power)
+        self.roster = Roster(storage.load_members(guild_id), next_id=storage.load_next_member_id(guild_id))
+        # List of leader candidates
+        self.leader_candidates = storage.load_leader_candidates(guild_id)
+
+        # Per-user selection state (excluded, carried, fixed and preferred members), loaded on first use
+        self.selections = SelectionStore(guild_id, storage, self.roster, selection_ttl)
+
+        # LRU cache of rendered auto_create_group results (only for calls with an explicit seed)
+        self.cache = GroupingCache(maxsize=cache_size)
+        # Autocomplete index over member names
+        self.name_index = NameIndex(self.roster.names())
+        # Last auto_create_group/regroup result per channel (for regroup), loaded on first use
+        self.groupings = {}
+        # Discord user -> roster member mapping for attendance-based grouping
+        self.attendance = AttendanceIndex(guild_id, storage, self.roster, self.name_index)
+
+        self.roster.subscribe(storage.roster_listener(guild_id))
+        self.roster.subscribe(lambda event, member, old_name=None: self.cache.clear())
+        self.roster.subscribe(self.name_index.roster_listener)
+        self.roster.subscribe(self.selections.roster_listener)
+        # After the name index, so that name matches are resolved against the updated index
+        self.roster.subscribe(self.attendance.roster_listener)
+
+    def seed(self, members, leader_candidates):
+        """Fills an empty shard with the seed roster and leader candidates."""
+        self.roster.apply_batch((member['name'], member['profession'], member['power']) for member in members)
+        self.leader_candidates[:] = leader_candidates
+        self.save_leader_candidates()
+
+    def save_user_state(self, user_id):
+        """
+        Queues a user's selection state for the next storage flush
+        and drops the grouping results cached for the old state.
+        """
+        self.cache.evict_user(user_id)
+        self.selections.save(user_id)
+
+    async def last_grouping(self, channel_id):
+        """Returns the last grouping made in a channel, or None. A grouping not in memory is loaded in a worker thread."""
+        if channel_id not in self.groupings:
+            grouping = await asyncio.to_thread(self.storage.load_grouping, self.guild_id, channel_id)
+            # A grouping saved in the meantime is newer than the loaded one
+            self.groupings.setdefault(channel_id, grouping)
+        return self.groupings[channel_id]
+
+    def save_grouping(self, channel_id, grouping):
+        """Remembers a channel's latest grouping and queues it for the next storage flush."""
+        self.groupings[channel_id] = grouping
+        self.storage.save_grouping(self.guild_id, channel_id, grouping)
+
+    def save_leader_candidates(self):
+        """
+        Queues the leader candidates for the next storage flush and drops every cached grouping result.
+        """
+        self.cache.clear()
+        self.storage.save_leader_candidates(self.guild_id, self.leader_candidates)
+
+
+class ShardManager:
+    """
+    Loads guild shards lazily on first use and evicts them once they have been idle for
+    `idle_timeout` seconds, so memory only holds the guilds that are actually active.
+    Shards whose stored state was changed by another bot process are dropped by drop_stale()
+    and reloaded on their next use. On the event loop, use get_async(), which loads in a worker thread.
+    """
+
+    def __init__(self, storage, idle_timeout, cache_size, selection_ttl, seed_members=(), seed_leader_candidates=()):
+        self.storage = storage
+        self.idle_timeout = idle_timeout
+        self.cache_size = cache_size
+        self.selection_ttl = selection_ttl
+        self.seed_members = list(seed_members)
+        self.seed_leader_candidates = list(seed_leader_candidates)
+        self._shards = {}
+        self._loading = {}  # guild_id -> task loading the shard in a worker thread
+
+    def __len__(self):
+        return len(self._shards)
+
+    def set_seed(self, seed_members, seed_leader_candidates):
+        """Replaces the seed used for guilds initialized from now on."""
+        self.seed_members = list(seed_members)
+        self.seed_leader_candidates = list(seed_leader_candidates)
+
+    def __iter__(self):
+        return iter(list(self._shards.values()))
+
+    def loaded(self, guild_id):
+        """Returns the shard of a guild if it is in memory, without loading it or marking it as used."""
+        return self._shards.get(guild_id)
+
+    def get(self, guild_id):
+        shard = self._shards.get(guild_id)
+        if shard is None:
+            shard = self._load(guild_id)
+            self._shards[guild_id] = shard
+        shard.last_used = time.monotonic()
+        return shard
+
+    async def get_async(self, guild_id):
+        """
+        Like get(), but a shard that is not in memory is loaded in a worker thread, so that the event loop
+        never waits for the database. Concurrent calls for the same guild share one load.
+        """
+        shard = self._shards.get(guild_id)
+        if shard is None:
+            loading = self._loading.get(guild_id)
+            if loading is None:
+                loading = asyncio.ensure_future(asyncio.to_thread(self._load, guild_id))
+                self._loading[guild_id] = loading
+                loading.add_done_callback(lambda _: self._loading.pop(guild_id, None))
+            shard = await asyncio.shield(loading)
+            shard = self._shards.setdefault(guild_id, shard)
+        shard.last_used = time.monotonic()
+        return shard
+
+    def _load(self, guild_id):
+        # Queued writes of an evicted shard must reach the database before it is read back;
+        # flush() also waits for a flush running on another thread
+        self.storage.flush()
+        self.storage.track(guild_id)
+        shard = GuildShard(guild_id, self.storage, self.cache_size, self.selection_ttl)
+        if not self.storage.has_guild(guild_id):
+            self.storage.add_guild(guild_id)
+            shard.seed(self.seed_members, self.seed_leader_candidates)
+        return shard
+
+    def evict_idle(self):
+        """
+        Drops every shard that has been idle for longer than `idle_timeout`, and the idle user selections
+        of the remaining shards. Returns the number of shards evicted.
+        """
+        deadline = time.monotonic() - self.idle_timeout
+        idle = [guild_id for guild_id, shard in self._shards.items() if shard.last_used < deadline]
+        for guild_id in idle:
+            del self._shards[guild_id]
+            self.storage.untrack(guild_id)
+        for shard in self._shards.values():
+            shard.selections.evict_idle()
+        return len(idle)
+
+    def drop_stale(self, guild_ids):
+        """Drops the shards of `guild_ids` (see Storage.stale_guilds). Returns the number dropped."""
+        dropped = 0
+        for guild_id in guild_ids:
+            if self._shards.pop(guild_id, None) is not None:
+                self.storage.untrack(guild_id)
+                dropped += 1
+        return dropped
@@ -0,0 +1,469 @@
+import json
+import sqlite3
+import threading
+import time
+from array import array
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id INTEGER PRIMARY KEY,
+    next_member_id INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS members (
+    guild_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    profession TEXT NOT NULL,
+    power INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, name)
+);
+CREATE TABLE IF NOT EXISTS leader_candidates (
+    guild_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (guild_id, position)
+);
+CREATE TABLE IF NOT EXISTS user_states (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS member_links (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    member_id INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS groupings (
+    guild_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    grouping TEXT NOT NULL,
+    PRIMARY KEY (guild_id, channel_id)
+);
+CREATE TABLE IF NOT EXISTS power_history (
+    guild_id INTEGER NOT NULL,
+    member_id INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    profession TEXT NOT NULL,
+    power INTEGER  -- NULL when the member was removed
+);
+CREATE INDEX IF NOT EXISTS power_history_time ON power_history (guild_id, ts);
+CREATE INDEX IF NOT EXISTS power_history_member ON power_history (guild_id, member_id, ts);
+CREATE TABLE IF NOT EXISTS power_snapshots (
+    guild_id INTEGER NOT NULL,
+    day_start INTEGER NOT NULL,
+    member_ids BLOB NOT NULL,
+    powers BLOB NOT NULL,
+    professions TEXT NOT NULL,
+    PRIMARY KEY (guild_id, day_start)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS revisions (
+    guild_id INTEGER PRIMARY KEY,
+    revision INTEGER NOT NULL
+);
+"""
+
+# Power snapshots are taken per day, with days starting at midnight in this UTC offset (Japan time)
+HISTORY_UTC_OFFSET = 9 * 3600
+
+
+def day_start(ts):
+    """Returns the start (unix time) of the history day containing `ts`."""
+    return int((ts + HISTORY_UTC_OFFSET) // 86400 * 86400 - HISTORY_UTC_OFFSET)
+
+
+class Storage:
+    """
+    SQLite (WAL mode) store for the roster, leader candidates, per-user selection state,
+    Discord user to member links and the last grouping of each channel of every guild. Changes are only queued in memory; flush() writes everything queued since the last
+    flush in a single transaction, so a burst of commands costs one commit.
+
+    Every power change is also appended to power_history. The first flush of a day stores the
+    powers of every member as of the start of that day in power_snapshots (columns packed as arrays),
+    so that the powers at any time can be rebuilt from one snapshot and at most a day of changes.
+
+    Several bot processes may share one database file. Every flush bumps the revision of the guilds
+    it wrote; stale_guilds() reports the tracked guilds another process has written since,
+    so that their in-memory state can be reloaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # isolation_level=None: transactions are started explicitly with BEGIN IMMEDIATE in flush()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        # Databases created before member ids had a high-water mark
+        if 'next_member_id' not in [row[1] for row in self._conn.execute('PRAGMA table_info(guilds)')]:
+            self._conn.execute('ALTER TABLE guilds ADD COLUMN next_member_id INTEGER NOT NULL DEFAULT 0')
+        self._lock = threading.Lock()     # guards the pending changes
+        self._db_lock = threading.Lock()  # guards the connection (flush runs on a worker thread)
+        # Loads use their own connection: in WAL mode they read the last commit without waiting for a flush,
+        # which may hold the connection for up to the 30 s busy timeout while another process writes.
+        # (An in-memory database only exists on one connection, so it is shared there.)
+        if path == ':memory:':
+            self._read_conn, self._read_lock = self._conn, self._db_lock
+        else:
+            self._read_conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._read_conn.execute('PRAGMA query_only=ON')
+            self._read_lock = threading.Lock()
+        self._pending_guilds = set()
+        self._pending_members = {}  # (guild_id, name) -> (profession, power, seq), or None when deleted
+        self._pending_leaders = {}  # guild_id -> names
+        self._pending_users = {}    # (guild_id, user_id) -> JSON encoded state
+        self._pending_links = {}    # (guild_id, user_id) -> member id, or None when unlinked
+        self._pending_groupings = {}  # (guild_id, channel_id) -> JSON encoded grouping
+        self._pending_next_ids = {}   # guild_id -> lowest member id never handed out
+        self._pending_history = []    # (guild_id, member_id, ts, profession, power or None)
+        self._flushing = {}         # the changes taken by the running flush until they are committed ('users', 'links', ...)
+        self._revisions = {}        # tracked guild_id -> revision the in-memory state is based on
+        self._stale = set()         # tracked guilds found to be written by another process during flush
+
+    def load_members(self, guild_id):
+        """Returns the stored roster of a guild as a list of records in registration order."""
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                'SELECT name, profession, power, seq FROM members WHERE guild_id = ? ORDER BY seq', (guild_id,)
+            ).fetchall()
+        return [{'name': name, 'profession': profession, 'power': power, 'seq': seq} for name, profession, power, seq in rows]
+
+    def load_next_member_id(self, guild_id):
+        """
+        Returns the lowest member id the guild has never used (including changes not flushed yet),
+        so that the id of a removed member is never given to a new one. Ids found in the power history
+        count as used too, which covers members removed before the high-water mark was stored.
+        """
+        # The queue is read first: a change committed in between is then still found in the database
+        with self._lock:
+            queued = max(self._pending_next_ids.get(guild_id, 0), self._flushing.get('next_ids', {}).get(guild_id, 0))
+        with self._read_lock:
+            stored = self._read_conn.execute(
+                'SELECT MAX(COALESCE((SELECT next_member_id FROM guilds WHERE guild_id = ?), 0), '
+                'COALESCE((SELECT MAX(seq) + 1 FROM members WHERE guild_id = ?), 0), '
+                'COALESCE((SELECT MAX(member_id) + 1 FROM power_history WHERE guild_id = ?), 0))',
+                (guild_id, guild_id, guild_id)
+            ).fetchone()[0]
+        return max(stored, queued)
+
+    def load_leader_candidates(self, guild_id):
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                'SELECT name FROM leader_candidates WHERE guild_id = ? ORDER BY position', (guild_id,)
+            ).fetchall()
+        return [name for (name,) in rows]
+
+    def load_user_state(self, guild_id, user_id):
+        """Returns a user's saved selection state (including changes not flushed yet), or None."""
+        with self._lock:
+            pending = self._pending_users.get((guild_id, user_id)) or self._flushing.get('users', {}).get((guild_id, user_id))
+        if pending is not None:
+            return json.loads(pending)
+        with self._read_lock:
+            row = self._read_conn.execute(
+                'SELECT state FROM user_states WHERE guild_id = ? AND user_id = ?', (guild_id, user_id)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_grouping(self, guild_id, channel_id):
+        """Returns the last grouping saved for a channel (including changes not flushed yet), or None."""
+        with self._lock:
+            pending = self._pending_groupings.get((guild_id, channel_id)) or self._flushing.get('groupings', {}).get((guild_id, channel_id))
+        if pending is not None:
+            return json.loads(pending)
+        with self._read_lock:
+            row = self._read_conn.execute(
+                'SELECT grouping FROM groupings WHERE guild_id = ? AND channel_id = ?', (guild_id, channel_id)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_power_snapshot(self, guild_id, ts):
+        """
+        Returns the latest power snapshot taken at or before `ts` as
+        (day_start, member ids, powers, professions), or None if there is none.
+        """
+        with self._read_lock:
+            row = self._read_conn.execute(
+                'SELECT day_start, member_ids, powers, professions FROM power_snapshots '
+                'WHERE guild_id = ? AND day_start <= ? ORDER BY day_start DESC LIMIT 1', (guild_id, ts)
+            ).fetchone()
+        if row is None:
+            return None
+        start, member_ids, powers, professions = row
+        return start, array('q', member_ids), array('q', powers), json.loads(professions)
+
+    def load_power_changes(self, guild_id, start, end):
+        """Returns the power changes from `start` (inclusive) to `end` (exclusive) as [(member_id, profession, power or None)] in time order."""
+        with self._read_lock:
+            return self._read_conn.execute(
+                'SELECT member_id, profession, power FROM power_history WHERE guild_id = ? AND ts >= ? AND ts < ? ORDER BY ts, rowid',
+                (guild_id, start, end)
+            ).fetchall()
+
+    def load_member_power_history(self, guild_id, member_id, limit):
+        """Returns a member's latest `limit` power changes as [(ts, power or None)], newest first."""
+        with self._read_lock:
+            return self._read_conn.execute(
+                'SELECT ts, power FROM power_history WHERE guild_id = ? AND member_id = ? ORDER BY ts DESC, rowid DESC LIMIT ?',
+                (guild_id, member_id, limit)
+            ).fetchall()
+
+    def load_member_links(self, guild_id):
+        """Returns the guild's Discord user to member links (including changes not flushed yet) as {user_id: member id}."""
+        # The queue is read first: a change committed in between is then still found in the database
+        with self._lock:
+            queued = [
+                (user_id, member_id) for queue in (self._flushing.get('links', {}), self._pending_links)
+                for (link_guild_id, user_id), member_id in queue.items() if link_guild_id == guild_id
+            ]
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                'SELECT user_id, member_id FROM member_links WHERE guild_id = ?', (guild_id,)
+            ).fetchall()
+        links = dict(rows)
+        for user_id, member_id in queued:
+            if member_id is None:
+                links.pop(user_id, None)
+            else:
+                links[user_id] = member_id
+        return links
+
+    def get_meta(self, key):
+        """Returns a stored bot-wide value (e.g. the command tree fingerprint), or None."""
+        with self._read_lock:
+            row = self._read_conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        """Stores a bot-wide value immediately (not queued for the next flush)."""
+        with self._db_lock:
+            self._conn.execute(
+                'INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                (key, value)
+            )
+
+    def has_guild(self, guild_id):
+        """Returns whether the guild has been initialized (seeded) before."""
+        with self._lock:
+            if guild_id in self._pending_guilds or guild_id in self._flushing.get('guilds', ()):
+                return True
+        with self._read_lock:
+            return self._read_conn.execute('SELECT 1 FROM guilds WHERE guild_id = ?', (guild_id,)).fetchone() is not None
+
+    def track(self, guild_id):
+        """
+        Remembers the current revision of a guild whose state is about to be loaded.
+        Call before the load_* methods, so that a concurrent write is reported as stale rather than missed.
+        Revisions are read on the flush's connection (like stale_guilds), so that they are never read between
+        a flush's commit and its update of the tracked revisions.
+        """
+        with self._db_lock:
+            row = self._conn.execute('SELECT revision FROM revisions WHERE guild_id = ?', (guild_id,)).fetchone()
+        with self._lock:
+            self._revisions[guild_id] = row[0] if row else 0
+            self._stale.discard(guild_id)
+
+    def untrack(self, guild_id):
+        with self._lock:
+            self._revisions.pop(guild_id, None)
+            self._stale.discard(guild_id)
+
+    def stale_guilds(self):
+        """Returns the tracked guilds whose stored state has been changed by another process."""
+        with self._db_lock:
+            rows = self._conn.execute('SELECT guild_id, revision FROM revisions').fetchall()
+        with self._lock:
+            stale = self._stale | {
+                guild_id for guild_id, revision in rows
+                if guild_id in self._revisions and revision != self._revisions[guild_id]
+            }
+            self._stale = set()
+            return stale
+
+    def add_guild(self, guild_id):
+        with self._lock:
+            self._pending_guilds.add(guild_id)
+
+    def roster_listener(self, guild_id):
+        """Returns a Roster change callback that queues the affected rows."""
+        def on_change(event, member, old_name=None):
+            with self._lock:
+                if event != 'rename':
+                    power = member.power if event != 'remove' else None
+                    self._pending_history.append((guild_id, member.id, time.time(), member.profession, power))
+                if event == 'add':
+                    self._pending_next_ids[guild_id] = max(self._pending_next_ids.get(guild_id, 0), member.id + 1)
+                if event == 'remove':
+                    self._pending_members[(guild_id, member.name)] = None
+                    return
+                if event == 'rename':
+                    self._pending_members[(guild_id, old_name)] = None
+                self._pending_members[(guild_id, member.name)] = (member.profession, member.power, member.id)
+        return on_change
+
+    def save_leader_candidates(self, guild_id, names):
+        with self._lock:
+            self._pending_leaders[guild_id] = list(names)
+
+    def save_user_state(self, guild_id, user_id, state):
+        encoded = json.dumps(state, ensure_ascii=False)
+        with self._lock:
+            self._pending_users[(guild_id, user_id)] = encoded
+
+    def save_member_link(self, guild_id, user_id, member_id):
+        with self._lock:
+            self._pending_links[(guild_id, user_id)] = member_id
+
+    def save_grouping(self, guild_id, channel_id, grouping):
+        encoded = json.dumps(grouping, ensure_ascii=False)
+        with self._lock:
+            self._pending_groupings[(guild_id, channel_id)] = encoded
+
+    def pending_count(self):
+        with self._lock:
+            return (
+                len(self._pending_guilds) + len(self._pending_members) + len(self._pending_leaders)
+                + len(self._pending_users) + len(self._pending_links) + len(self._pending_groupings)
+                + len(self._pending_history) + len(self._pending_next_ids)
+            )
+
+    def flush(self):
+        """
+        Writes every queued change in one transaction. Safe to call from a worker thread.
+        Loads do not wait for it: until the commit they see the changes it is writing as still queued.
+        Calling it also waits for a flush running on another thread, so it can be used to make the
+        queued changes readable by queries that do not look at the queue (load_members, the power history).
+        """
+        with self._db_lock:
+            with self._lock:
+                guilds, self._pending_guilds = self._pending_guilds, set()
+                members, self._pending_members = self._pending_members, {}
+                leaders, self._pending_leaders = self._pending_leaders, {}
+                users, self._pending_users = self._pending_users, {}
+                links, self._pending_links = self._pending_links, {}
+                groupings, self._pending_groupings = self._pending_groupings, {}
+                history, self._pending_history = self._pending_history, []
+                next_ids, self._pending_next_ids = self._pending_next_ids, {}
+                self._flushing = {'guilds': guilds, 'users': users, 'links': links, 'groupings': groupings, 'next_ids': next_ids}
+
+            if not guilds and not members and not leaders and not users and not links and not groupings and not history and not next_ids:
+                with self._lock:
+                    self._flushing = {}
+                return
+
+            touched = (
+                guilds | {key[0] for key in members} | set(leaders) | {key[0] for key in users}
+                | {key[0] for key in links} | {key[0] for key in groupings} | {row[0] for row in history} | set(next_ids)
+            )
+            # IMMEDIATE takes the write lock up front, so the revision check below cannot race another process
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                revisions = self._bump_revisions(touched)
+                self._conn.executemany('INSERT OR IGNORE INTO guilds (guild_id) VALUES (?)', [(guild_id,) for guild_id in guilds])
+                self._conn.executemany(
+                    'UPDATE guilds SET next_member_id = MAX(next_member_id, ?) WHERE guild_id = ?',
+                    [(next_id, guild_id) for guild_id, next_id in next_ids.items()]
+                )
+                # Before the member rows are written, so that the snapshot holds the powers at the start of the day
+                self._take_snapshots(history)
+                self._conn.executemany(
+                    'INSERT INTO power_history (guild_id, member_id, ts, profession, power) VALUES (?, ?, ?, ?, ?)', history
+                )
+                deleted = [key for key, row in members.items() if row is None]
+                upserted = [key + row for key, row in members.items() if row is not None]
+                self._conn.executemany('DELETE FROM members WHERE guild_id = ? AND name = ?', deleted)
+                self._conn.executemany(
+                    'INSERT INTO members (guild_id, name, profession, power, seq) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT(guild_id, name) DO UPDATE SET profession = excluded.profession, power = excluded.power, seq = excluded.seq',
+                    upserted
+                )
+                for guild_id, names in leaders.items():
+                    self._conn.execute('DELETE FROM leader_candidates WHERE guild_id = ?', (guild_id,))
+                    self._conn.executemany(
+                        'INSERT INTO leader_candidates (guild_id, position, name) VALUES (?, ?, ?)',
+                        [(guild_id, position, name) for position, name in enumerate(names)]
+                    )
+                self._conn.executemany(
+                    'INSERT INTO user_states (guild_id, user_id, state) VALUES (?, ?, ?) '
+                    'ON CONFLICT(guild_id, user_id) DO UPDATE SET state = excluded.state',
+                    [key + (state,) for key, state in users.items()]
+                )
+                self._conn.executemany(
+                    'DELETE FROM member_links WHERE guild_id = ? AND user_id = ?',
+                    [key for key, member_id in links.items() if member_id is None]
+                )
+                self._conn.executemany(
+                    'INSERT INTO member_links (guild_id, user_id, member_id) VALUES (?, ?, ?) '
+                    'ON CONFLICT(guild_id, user_id) DO UPDATE SET member_id = excluded.member_id',
+                    [key + (member_id,) for key, member_id in links.items() if member_id is not None]
+                )
+                self._conn.executemany(
+                    'INSERT INTO groupings (guild_id, channel_id, grouping) VALUES (?, ?, ?) '
+                    'ON CONFLICT(guild_id, channel_id) DO UPDATE SET grouping = excluded.grouping',
+                    [key + (grouping,) for key, grouping in groupings.items()]
+                )
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                with self._lock:
+                    self._flushing = {}
+                raise
+            self._conn.execute('COMMIT')
+
+            with self._lock:
+                self._flushing = {}
+                for guild_id, (before, after) in revisions.items():
+                    if guild_id not in self._revisions:
+                        continue
+                    if before != self._revisions[guild_id]:
+                        self._stale.add(guild_id)
+                    self._revisions[guild_id] = after
+
+    def _take_snapshots(self, history):
+        """Stores the day's power snapshot of each guild in `history` that has none for the day of its first change."""
+        first_change = {}
+        for guild_id, _, ts, _, _ in history:
+            first_change[guild_id] = min(ts, first_change.get(guild_id, ts))
+        for guild_id, ts in first_change.items():
+            start = day_start(ts)
+            exists = self._conn.execute(
+                'SELECT 1 FROM power_snapshots WHERE guild_id = ? AND day_start = ?', (guild_id, start)
+            ).fetchone()
+            if exists:
+                continue
+            rows = self._conn.execute(
+                'SELECT seq, power, profession FROM members WHERE guild_id = ? ORDER BY seq', (guild_id,)
+            ).fetchall()
+            self._conn.execute(
+                'INSERT INTO power_snapshots (guild_id, day_start, member_ids, powers, professions) VALUES (?, ?, ?, ?, ?)',
+                (
+                    guild_id, start,
+                    array('q', [row[0] for row in rows]).tobytes(),
+                    array('q', [row[1] for row in rows]).tobytes(),
+                    json.dumps([row[2] for row in rows], ensure_ascii=False)
+                )
+            )
+
+    def _bump_revisions(self, guild_ids):
+        """Increments the revision of each guild; returns guild_id -> (old revision, new revision)."""
+        revisions = {}
+        for guild_id in guild_ids:
+            row = self._conn.execute('SELECT revision FROM revisions WHERE guild_id = ?', (guild_id,)).fetchone()
+            before = row[0] if row else 0
+            self._conn.execute(
+                'INSERT INTO revisions (guild_id, revision) VALUES (?, ?) '
+                'ON CONFLICT(guild_id) DO UPDATE SET revision = excluded.revision',
+                (guild_id, before + 1)
+            )
+            revisions[guild_id] = (before, before + 1)
+        return revisions
+
+    def close(self):
+        self.flush()
+        if self._read_conn is not self._conn:
+            self._read_conn.close()
+        self._conn.close()
@@ -1,13 +1,63 @@
-from flask import Flask
+from flask import Flask, Response, jsonify
 from threading import Thread
 import os
+import time
+
+from health import HealthReader, check_health, check_ready
 
 app = Flask(__name__)
 
+# File the bot dumps its metrics to (see METRICS_PATH in bot.py)
+METRICS_PATH = os.environ.get('METRICS_PATH', 'metrics.prom')
+
+# Shared memory segments the bot processes publish their health to (comma separated, see HEALTH_SHM_NAME in bot.py)
+HEALTH_READERS = [HealthReader(name) for name in os.environ.get('HEALTH_SHM_NAMES', 'tansan_health').split(',')]
+# A snapshot older than this (seconds) means the bot is dead or stuck
+HEALTH_MAX_AGE = float(os.environ.get('HEALTH_MAX_AGE', '30'))
+# Event loop lag (seconds) above which the bot counts as unhealthy
+HEALTH_MAX_LOOP_LAG = float(os.environ.get('HEALTH_MAX_LOOP_LAG', '5'))
+# Gateway heartbeat latency (seconds) above which the bot counts as not ready
+HEALTH_MAX_LATENCY = float(os.environ.get('HEALTH_MAX_LATENCY', '2'))
+
+def read_snapshots():
+    snapshots = []
+    for reader in HEALTH_READERS:
+        snapshot = reader.read()
+        if snapshot is None or time.time() - snapshot.get('updated', 0) > HEALTH_MAX_AGE:
+            # The bot may have been restarted with a new segment; attach again
+            reader.reset()
+            snapshot = reader.read()
+        snapshots.append((reader.name, snapshot))
+    return snapshots
+
+def health_response(check):
+    results = {}
+    for name, snapshot in read_snapshots():
+        results[name] = {'problems': check(snapshot), 'snapshot': snapshot}
+    ok = not any(result['problems'] for result in results.values())
+    return jsonify({'ok': ok, 'processes': results}), 200 if ok else 503
+
 @app.route('/')
 def home():
     return "Discord Bot is running!"
 
+@app.route('/healthz')
+def healthz():
+    return health_response(lambda snapshot: check_health(snapshot, HEALTH_MAX_AGE, HEALTH_MAX_LOOP_LAG))
+
+@app.route('/readyz')
+def readyz():
+    return health_response(lambda snapshot: check_ready(snapshot, HEALTH_MAX_AGE, HEALTH_MAX_LOOP_LAG, HEALTH_MAX_LATENCY))
+
+@app.route('/metrics')
+def metrics():
+    try:
+        with open(METRICS_PATH, encoding='utf-8') as f:
+            body = f.read()
+    except OSError:
+        return Response('# metrics not available yet\n', status=503, mimetype='text/plain')
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file